@@ -0,0 +1,107 @@
+"""A sprite group that finds the sprites touching a sprite without testing it
+against every sprite in the group.  Members are filed in a SpatialGrid by
+their rects, and ManipulatableDirtySprites tell the group when they change, so
+only the ones that moved are filed again before a query."""
+
+import pygame
+import SpatialGrid
+
+
+class CollisionGroup(pygame.sprite.Group):
+    """This class is a pygame Group with a broad phase for collision tests.
+The narrow test, a callback as taken by pygame.sprite.spritecollide, is only
+run on sprites whose rects overlap; without one the rects alone decide.  Pass
+pygame.sprite.collide_mask to use the cached masks of
+ManipulatableDirtySprites.  Sprites that cannot report their changes are
+filed again before every query, so groups of those gain less."""
+    #The size of the cells sprites are filed in, in pixels.
+    cellSize = 64
+
+    def __init__(self, *sprites):
+        #_moved holds the sprites that reported a change since the last
+        #query, and _polled the ones that cannot.
+        self._index = SpatialGrid.SpatialGrid(self.cellSize)
+        self._moved = set()
+        self._polled = []
+        super(CollisionGroup, self).__init__(*sprites)
+
+    def add_internal(self, sprite, *args):
+        super(CollisionGroup, self).add_internal(sprite, *args)
+        if hasattr(sprite, '_windows'):
+            sprite._windows += (self,)
+            self._moved.add(sprite)
+        else:
+            self._polled.append(sprite)
+
+    def remove_internal(self, sprite):
+        super(CollisionGroup, self).remove_internal(sprite)
+        if hasattr(sprite, '_windows'):
+            sprite._windows = tuple(w for w in sprite._windows if w is not self)
+        if sprite in self._polled:
+            self._polled.remove(sprite)
+        self._moved.discard(sprite)
+        self._index.remove(sprite)
+
+    def _childDirty(self, child, value):
+        """Called by a member whenever it changes or its dirty flag is set."""
+        if value != 0:
+            self._moved.add(child)
+
+    @staticmethod
+    def _rect(sprite):
+        """Return the rect of sprite, without copying it if it can help it."""
+        if hasattr(sprite, 'rectView'):
+            return sprite.rectView
+        return sprite.rect
+
+    def _refresh(self):
+        """File the sprites that changed since the last query again."""
+        moved = self._moved
+        self._moved = set()
+        index = self._index
+        for sprite in moved:
+            index.insert(sprite, CollisionGroup._rect(sprite))
+        for sprite in self._polled:
+            index.insert(sprite, CollisionGroup._rect(sprite))
+
+    def collide(self, sprite, collided = None):
+        """Return a list of the sprites in this group that collide with
+sprite, in no particular order.  sprite itself is never in the list."""
+        self._refresh()
+        return self._collide(sprite, collided)
+
+    def _collide(self, sprite, collided):
+        """collide, without filing changed sprites first."""
+        found = self._index.query(CollisionGroup._rect(sprite))
+        found.discard(sprite)
+        if collided is None:
+            return list(found)
+        return [o for o in found if collided(sprite, o)]
+
+    def collideGroup(self, group, collided = None):
+        """Return a dict mapping each sprite of group that collides with any
+sprite in this group to the list of those it collides with."""
+        self._refresh()
+        hits = {}
+        for sprite in group:
+            found = self._collide(sprite, collided)
+            if found:
+                hits[sprite] = found
+        return hits
+
+    def collidePairs(self, collided = None):
+        """Return a list of every pair of sprites in this group that collide
+with each other, each pair once."""
+        self._refresh()
+        index = self._index
+        pairs = []
+        done = set()
+        for sprite in self.sprites():
+            done.add(sprite)
+            rect = index.rect(sprite)
+            if rect is None:
+                continue
+            for other in index.query(rect):
+                if other not in done and (collided is None or collided(sprite, other)):
+                    pairs.append((sprite, other))
+        return pairs
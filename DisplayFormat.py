@@ -0,0 +1,94 @@
+"""Helpers to keep cached sprite surfaces in the pixel format of the display.
+Blitting a surface whose format differs from the screen's goes through a slow
+per-pixel conversion on every draw, so surfaces that are drawn more than once
+are better converted up front.  The display format is tracked by a generation
+number that changes whenever the mode does, so converted surfaces know when
+they must be converted again."""
+
+import pygame
+from pygame.locals import *
+
+_display = None
+_size = None
+_format = None
+_generation = 0
+
+def generation():
+    """Return a number that changes whenever the display format changes.
+Only the identity and size of the display surface are checked on each call;
+the format itself is compared only when one of those has changed."""
+    global _display, _size, _format, _generation
+    display = pygame.display.get_surface()
+    if display is None:
+        if _display is not None:
+            displayChanged()
+        return _generation
+    size = display.get_size()
+    if display is not _display or size != _size:
+        _display = display
+        _size = size
+        format = (display.get_bitsize(), display.get_masks())
+        if format != _format:
+            _format = format
+            _generation += 1
+    return _generation
+
+def displayChanged():
+    """Force every converted surface to be converted again.  Call this after
+changing the display mode if the change may not be caught by generation."""
+    global _display, _size, _format, _generation
+    _display = _size = _format = None
+    _generation += 1
+
+def isDisplayFormat(surface):
+    """Return whether surface already matches the display's pixel format."""
+    generation()
+    if _format is None:
+        return True
+    bitsize, masks = _format
+    if surface.get_bitsize() != bitsize:
+        return False
+    #Per-pixel alpha surfaces only need the color masks to line up.
+    return surface.get_masks()[:3] == masks[:3]
+
+def convert(surface, rle = False):
+    """Return surface in the display format, or surface itself if it already
+is or there is no display yet.  Per-pixel alpha goes through convert_alpha,
+everything else through convert, keeping the colorkey and surface alpha.  If
+rle is set, the surface returned is also RLE accelerated, which suits
+surfaces that are drawn often and changed rarely.  A surface already in the
+display format is copied for that, unless it is RLE accelerated already.
+The surface passed in is never changed."""
+    if pygame.display.get_surface() is None:
+        return surface
+    alpha = surface.get_alpha()
+    colorkey = surface.get_colorkey()
+    flags = rle and RLEACCEL or 0
+    #RLE only helps surfaces with see-through parts.
+    if colorkey is None and alpha is None and not surface.get_flags() & SRCALPHA:
+        flags = 0
+    if isDisplayFormat(surface):
+        if not flags or surface.get_flags() & (RLEACCEL | RLEACCELOK):
+            return surface
+        converted = surface.copy()
+    elif surface.get_flags() & SRCALPHA:
+        converted = surface.convert_alpha()
+    else:
+        converted = surface.convert()
+    if colorkey is not None:
+        converted.set_colorkey(colorkey, flags)
+    if alpha is not None:
+        converted.set_alpha(alpha, flags)
+    elif flags and colorkey is None and converted.get_flags() & SRCALPHA:
+        converted.set_alpha(255, flags)
+    return converted
+
+def surface(size, flags = SRCALPHA):
+    """Make a new surface of size, in the display format if there is a
+display."""
+    image = pygame.Surface(size, flags)
+    if pygame.display.get_surface() is None:
+        return image
+    if flags & SRCALPHA:
+        return image.convert_alpha()
+    return image.convert()
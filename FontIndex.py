@@ -0,0 +1,109 @@
+"""A process wide index of the system fonts, built the first time a font is
+looked up.  Scanning the system fonts is slow, so the file each font name
+resolves to is remembered, and can be kept on disk between runs by setting
+cachePath.  Fonts are shared by everything that asks for the same file, size
+and style.  Each style gets a font of its own, so the style of a font handed
+out never changes."""
+
+import os
+import json
+import pygame
+
+#cachePath is a file to keep resolved font names in between runs, or None.
+cachePath = None
+
+#_names is the list of system font names, or None until it is needed.  _files
+#maps a font name asked for to the file it resolved to, None meaning the
+#default font, and _fonts maps (file, size, bold, italic, underline) to a
+#loaded font.  _keys maps each loaded font back to its key.
+_names = None
+_files = {}
+_fonts = {}
+_keys = {}
+#_loaded is the cachePath last read from.
+_loaded = None
+
+def _load():
+    """Read the resolved names kept at cachePath, once for each path.  Names
+resolved to files that are gone are left out."""
+    global _loaded
+    if _loaded == cachePath:
+        return
+    _loaded = cachePath
+    if cachePath is None:
+        return
+    try:
+        with open(cachePath) as f:
+            files = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+    for name, file in files.items():
+        if name not in _files and (file is None or os.path.exists(file)):
+            _files[name] = file
+
+def _save():
+    """Write the resolved names to cachePath, if it is set.  The cache is
+only a speedup, so failing to write it is not an error."""
+    if cachePath is None:
+        return
+    try:
+        with open(cachePath, 'w') as f:
+            json.dump(_files, f)
+    except (IOError, OSError):
+        pass
+
+def resolve(fontName):
+    """Return the file of the first system font whose name contains
+fontName, or None if there is none and the default font is to be used."""
+    global _names
+    _load()
+    if fontName in _files:
+        return _files[fontName]
+    if _names is None:
+        _names = pygame.font.get_fonts()
+    choices = [name for name in _names if name.find(fontName) != -1]
+    file = None
+    if choices:
+        file = pygame.font.match_font(choices[0])
+    _files[fontName] = file
+    _save()
+    return file
+
+def font(fontName, size, bold = False, italic = False, underline = False):
+    """Return the shared font for fontName at size, in the style given.  It
+must not be restyled."""
+    file = resolve(fontName) or pygame.font.get_default_font()
+    key = (file, size, bool(bold), bool(italic), bool(underline))
+    if key not in _fonts:
+        loaded = _fonts[key] = _open(key)
+        _keys[loaded] = key
+    return _fonts[key]
+
+def _open(key):
+    """Load the font for key, in its style."""
+    file, size, bold, italic, underline = key
+    loaded = pygame.font.Font(file, size)
+    loaded.set_bold(bold)
+    loaded.set_italic(italic)
+    loaded.set_underline(underline)
+    return loaded
+
+def fontKey(font):
+    """Return the (file, size, bold, italic, underline) key of a font handed
+out by font, or None."""
+    return _keys.get(font)
+
+def unshared(key):
+    """Load a new font for key that is handed to nothing else.  A font must
+not be used by two threads at once, so other threads render with fonts of
+their own, which must be loaded on the main thread: the font library cannot
+load fonts on two threads at once."""
+    return _open(key)
+
+def rescan():
+    """Forget the system fonts and every resolved name, so fonts installed
+since are found.  Fonts already loaded are kept."""
+    global _names
+    _names = None
+    _files.clear()
+    _save()
@@ -0,0 +1,73 @@
+"""A least recently used store of rendered glyphs, shared by every TextBox.
+Text is put together from glyphs kept here, so a string that changes only has
+its new characters rendered."""
+
+import collections
+import pygame
+from pygame.locals import *
+
+
+class GlyphCache(object):
+    """This class holds single character surfaces keyed by font, antialiasing
+and color.  Fonts come from FontIndex, which has one font for each file, size
+and style, so the font stands for all of those in the key.  Once more than
+maxEntries are held, the least recently used are dropped."""
+
+    def __init__(self, maxEntries = 8192):
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        """Return the entry stored for key, or None, marking it as most
+recently used."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry
+
+    def _put(self, key, entry):
+        """Store entry under key, dropping the oldest entries past the
+limit."""
+        self._entries[key] = entry
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(False)
+
+    def glyph(self, font, antialias, color, char):
+        """Return the surface of char rendered in font.  The surface always
+has per-pixel alpha, so glyphs can be merged with BLEND_RGBA_MAX."""
+        color = tuple(color)
+        key = (font, antialias, color, char)
+        glyph = self._get(key)
+        if glyph is None:
+            glyph = font.render(char, antialias, color)
+            if not glyph.get_flags() & SRCALPHA:
+                #Unantialiased glyphs come with a colorkey instead.
+                surface = pygame.Surface(glyph.get_size(), SRCALPHA)
+                surface.fill((0, 0, 0, 0))
+                surface.blit(glyph, (0, 0))
+                glyph = surface
+            self._put(key, glyph)
+        return glyph
+
+    def measure(self, font, text):
+        """Return the width of text drawn in font."""
+        return font.size(text)[0]
+
+    def place(self, font, text):
+        """Return where the glyph of the last character of text goes when
+text is drawn in one piece: the width of text less that of the glyph.
+Measuring the whole of text keeps the kerning and the fractional advances
+that adding up single glyph widths would lose."""
+        return font.size(text)[0] - font.size(text[-1])[0]
+
+    def clear(self):
+        """Drop every cached glyph."""
+        self._entries.clear()
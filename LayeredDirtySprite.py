@@ -1,12 +1,81 @@
 """This group has user modifyable height and width, acting as a window for the
 sprites contained by this group.  Locations are always relative to the upper
-left corner of the window, in pygame coordinate fashion.  The group window can
+left corner of the window's content, in pygame coordinate fashion; the content
+can be scrolled with scroll_x and scroll_y.  The group window can
 then be positioned and manipulated like a sprite itself.  This object inherits
 from the ManipulatableDirtySprite, so it can be scaled, rotated, and faded."""
 
 import pygame
 from pygame.locals import *
+import math
 import ManipulatableDirtySprite
+import DisplayFormat
+import SpatialGrid
+import TextBox
+
+
+class _ChildGroup(pygame.sprite.LayeredDirty):
+    """The LayeredDirty group behind a LayeredDirtySprite.  It tells its window
+whenever a sprite joins or leaves it, however that comes about, and only
+draws the sprites the window can show."""
+    window = None
+
+    def add_internal(self, sprite, layer = None):
+        super(_ChildGroup, self).add_internal(sprite, layer)
+        self.window._adopt(sprite)
+
+    def remove_internal(self, sprite):
+        super(_ChildGroup, self).remove_internal(sprite)
+        self.window._disown(sprite)
+
+    def change_layer(self, sprite, new_layer):
+        super(_ChildGroup, self).change_layer(sprite, new_layer)
+        #The sprite now goes on top of its new layer.
+        self.window._reorder(sprite)
+
+    def draw(self, surface, bgd = None):
+        sprites = self._spritelist
+        self._spritelist = self.window._inView()
+        try:
+            return super(_ChildGroup, self).draw(surface, bgd)
+        finally:
+            self._spritelist = sprites
+
+
+class _ScrolledView(object):
+    """Stands in for the cache surface while a window draws its children.
+LayeredDirty works in the children's content coordinates, so every blit is
+shifted by the scroll offset on its way to the surface.  The rects handed back
+are where the source would be if nothing were clipped, as LayeredDirty keeps
+them to know what to clear next time; a sprite only partly in view may come
+further into it by scrolling without being drawn again."""
+
+    def __init__(self, surface, background, x, y):
+        self.surface = surface
+        self.background = background
+        self.x = x
+        self.y = y
+
+    def blit(self, source, dest, area = None, special_flags = 0):
+        x, y = self.x, self.y
+        #The background lines up with the cache, not with the content.
+        if source is self.background and area is not None:
+            area = pygame.Rect(area).move(-x, -y)
+        self.surface.blit(source, (dest[0] - x, dest[1] - y), area, special_flags)
+        if area is None:
+            return pygame.Rect((dest[0], dest[1]), source.get_size())
+        return pygame.Rect((dest[0], dest[1]), pygame.Rect(area).size)
+
+    def get_clip(self):
+        return self.surface.get_clip().move(self.x, self.y)
+
+    def set_clip(self, rect = None):
+        if rect is not None:
+            rect = pygame.Rect(rect).move(-self.x, -self.y)
+        self.surface.set_clip(rect)
+
+    def __getattr__(self, name):
+        return getattr(self.surface, name)
 
 
 class LayeredDirtySprite(ManipulatableDirtySprite.ManipulatableDirtySprite):
@@ -17,28 +86,283 @@ All sprites are then drawn relative to the origin of this object.  This
 object attempts to optimize the rendering of the children objects by creating a
 image cache of the children."""
     _blankImage = None
-    _dirty = 1
+    #_backing holds the cache surface _image is a view of.  Both it and
+    #_blankImage may be larger than the window, leaving room to grow.
+    _backing = None
     _group = None
+    #_dirtyChildren holds the children that have reported a change, to be
+    #filed again in _index and checked against the view.
+    _dirtyChildren = None
+    #_index files every child by rect, so only those in view are drawn, and
+    #_order holds the order children were put on their layers in.
+    _index = None
+    _order = None
+    _added = 0
+    #_polled holds the children that cannot report it, so are checked when
+    #dirty is read: sprites without the hook, and windows that poll.
+    _polled = None
+    #_regions holds the areas of the cache surface redrawn by the last repaint.
+    _regions = ()
+    #_scrollX and _scrollY are the content coordinates shown at the top left
+    #corner, and _shifted is set once the cache has been scrolled since the
+    #last repaint.
+    _scrollX = 0
+    _scrollY = 0
+    _shifted = False
+    #_flatten turns on drawing the children straight into the finished image.
+    #_flattened is set once that was last done, leaving the cache behind, and
+    #_flatImage is the surface it was done on.  _shadows holds the sprites
+    #that render each child with the transforms put together.
+    _flatten = False
+    _flattened = False
+    _flatImage = None
+    _shadows = None
+    #_hidden holds the children left out behind opaque children with no
+    #drawn rect on record, so they are drawn in full once they show again.
+    _hidden = None
+    #_format is the display format generation the cache surfaces are in.
+    _format = None
+    #_size is the width and height of the window itself.  _rect is placed by
+    #the pipeline, so it takes the scaled and rotated size.
+    _size = (1, 1)
+    #The cache surface is redrawn in place, so its frames cannot be shared,
+    #nor can the last one be kept while it waits for a scheduler.
+    transformCache = None
+    atlasSteps = None
+    scheduler = None
+    #cellSize is the size of the squares children are filed under.
+    cellSize = 64
 
     def __init__(self, width = None, height = None, *args, **kwargs):
         """Standard init- call both parent classes."""
+        self._dirtyChildren = set()
+        self._polled = []
+        self._index = SpatialGrid.SpatialGrid(self.cellSize)
+        self._order = {}
+        self._shadows = {}
+        self._hidden = set()
         super(LayeredDirtySprite, self).__init__(self, *args, **kwargs)
-        self._group =  pygame.sprite.LayeredDirty(**kwargs)
+        self._group =  _ChildGroup(**kwargs)
+        self._group.window = self
         self._rect = pygame.Rect(0, 0, 1, 1)
         if width: self.width = width
         if height: self.height = height
         self._updateImage()
 
     def _updateImage(self):
-        """Updates the bounds of the group's overall rectangle.  Additionally
-resizes the cache surface, if needed."""
-        if (self._blankImage == None
-          or self._blankImage.get_width != self._rect.w 
-          or self._blankImage.get_height != self._rect.h):
-            self._blankImage = pygame.Surface((max((1, self._rect.w)), max((1, self._rect.h))), SRCALPHA)
-            self._image = self._blankImage.copy()
-            for o in self._group.sprites():
-                if 'dirty' in dir(o) and o.dirty == 0: o.dirty = 1
+        """Updates the bounds of the group's overall rectangle.  The cache is a
+view onto a larger backing surface, which is only replaced once the window
+outgrows it; growing within it repaints just the newly exposed area."""
+        w, h = max((1, self._size[0])), max((1, self._size[1]))
+        generation = DisplayFormat.generation()
+        backing = self._backing
+        if self._image != None and (w, h) == self._image.get_size() and self._format == generation:
+            return
+        if (backing == None or self._format != generation
+          or w > backing.get_width() or h > backing.get_height()):
+            size = (LayeredDirtySprite._capacity(w), LayeredDirtySprite._capacity(h))
+            if backing != None:
+                size = (max((size[0], backing.get_width())), max((size[1], backing.get_height())))
+            self._blankImage = DisplayFormat.surface(size)
+            self._backing = self._blankImage.copy()
+            #Copy the blank pixels over rather than blend them, so clearing
+            #an area with it really makes it transparent.
+            self._blankImage.set_alpha(None)
+            if backing != None and self._format == generation:
+                #Keep what was already drawn; only the new area needs drawing.
+                self._backing.blit(self._image, (0, 0))
+            else:
+                backing = None
+            self._format = generation
+        if backing == None:
+            #Everything must be drawn again.
+            self._repaint(pygame.Rect(0, 0, w, h))
+        else:
+            #Repaint the strips uncovered to the right and below.
+            oldw, oldh = self._image.get_size()
+            if w > oldw:
+                self._repaint(pygame.Rect(oldw, 0, w - oldw, h))
+            if h > oldh:
+                self._repaint(pygame.Rect(0, oldh, min((w, oldw)), h - oldh))
+        if self._dirty == 0: self.dirty = 1
+        self._image = self._backing.subsurface((0, 0, w, h))
+        self._pending |= ManipulatableDirtySprite.STAGE_IMAGE
+
+    def _repaint(self, rect):
+        """Queue an area of the cache, in cache coordinates, to be redrawn."""
+        self._group.repaint_rect(rect.move(self._scrollX, self._scrollY))
+
+    @staticmethod
+    def _capacity(size):
+        """Return the backing size to allocate for size: the next power of
+two, so a growing window is only reallocated a few times."""
+        capacity = 1
+        while capacity < size:
+            capacity *= 2
+        return capacity
+
+    def _adopt(self, child):
+        """Start tracking the dirty state of a child that joined the group."""
+        if self._dirty == 0: self.dirty = 1
+        self._reorder(child)
+        self._index.insert(child, LayeredDirtySprite._bounds(child))
+        if hasattr(child, '_windows'):
+            child._windows += (self,)
+            self._childDirty(child, 1)
+            if not getattr(child, '_polled', None):
+                return
+        self._polled.append(child)
+        #Our parents cannot be told about this child, so they must poll us.
+        if len(self._polled) == 1:
+            for window in self._windows:
+                if self not in window._polled: window._polled.append(self)
+
+    def _disown(self, child):
+        """Stop tracking a child that left the group."""
+        if self._dirty == 0: self.dirty = 1
+        if hasattr(child, '_windows'):
+            child._windows = tuple(w for w in child._windows if w is not self)
+        self._dirtyChildren.discard(child)
+        self._index.remove(child)
+        self._order.pop(child, None)
+        self._shadows.pop(child, None)
+        self._hidden.discard(child)
+        if child in self._polled:
+            self._polled.remove(child)
+
+    def _reorder(self, child):
+        """Note that child was just put on top of its layer."""
+        self._added += 1
+        self._order[child] = self._added
+
+    def _childDirty(self, child, value):
+        """Called by a child whenever it changes or its dirty flag is set.
+Whether that shows is only worked out when it is asked for, so our own
+windows are just told that we may have changed."""
+        if value != 0:
+            self._dirtyChildren.add(child)
+            self._invalidate(0)
+        else:
+            self._dirtyChildren.discard(child)
+
+    @staticmethod
+    def _bounds(child):
+        """Return where child is, without bringing it up to date if it has
+transforms pending or text to draw."""
+        if isinstance(child, ManipulatableDirtySprite.ManipulatableDirtySprite):
+            return child.bounds
+        if isinstance(child, TextBox.TextBox):
+            #Drawing text never moves or resizes a TextBox.
+            return child._rect
+        return child.rect
+
+    def _view(self):
+        """Return the area of the content shown, in content coordinates."""
+        w, h = self._image.get_size()
+        return pygame.Rect(self._scrollX, self._scrollY, w, h)
+
+    def _refresh(self):
+        """File the children that changed since the last call in the index
+again, and return whether any of them shows.  Children outside the view are
+left with their changes pending until they come into it.  A child that left
+the view has the area it was drawn in repainted."""
+        polled = [o for o in self._polled if getattr(o, 'dirty', 1) != 0]
+        if not self._dirtyChildren and not polled:
+            return False
+        changed = self._dirtyChildren
+        self._dirtyChildren = set()
+        view = self._view()
+        index = self._index
+        drawn = self._group.spritedict
+        shows = False
+        for child in polled:
+            index.insert(child, LayeredDirtySprite._bounds(child))
+            shows = True
+        for child in changed:
+            rect = LayeredDirtySprite._bounds(child)
+            index.insert(child, rect)
+            if view.colliderect(rect):
+                #Keep it until it has been drawn.
+                self._dirtyChildren.add(child)
+                shows = True
+                continue
+            old = drawn.get(child)
+            if old and view.colliderect(old):
+                self._group.repaint_rect(old)
+                drawn[child] = self._group._init_rect
+                shows = True
+        return shows
+
+    def _inView(self):
+        """Return the children in view that are not hidden behind opaque
+children above them, in the order they are drawn in.  Hidden children are
+neither drawn nor brought up to date."""
+        layer = self._group.get_layer_of_sprite
+        order = self._order
+        children = sorted(self._index.query(self._view()), key = lambda o: (layer(o), order[o]))
+        rect = self._index.rect
+        cover = []
+        shown = []
+        for child in reversed(children):
+            if cover and LayeredDirtySprite._covered(rect(child), cover):
+                self._hide(child)
+                continue
+            if child in self._hidden:
+                #LayeredDirty only records the rect of a sprite drawn in full,
+                #and without it the child's next move would leave a ghost.
+                self._hidden.discard(child)
+                child.dirty = 1
+            shown.append(child)
+            if (getattr(child, 'opaque', False) and getattr(child, 'visible', 1)
+              and not getattr(child, 'blendmode', 0) and getattr(child, 'source_rect', None) is None):
+                cover.append(child.rectView if hasattr(child, 'rectView') else child.rect)
+        shown.reverse()
+        return shown
+
+    def _hide(self, child):
+        """Leave out a hidden child.  If it changed, the area it was last
+drawn in is repainted, and it is marked clean so it does not keep this window
+dirty."""
+        if isinstance(child, ManipulatableDirtySprite.ManipulatableDirtySprite):
+            dirty = child._dirty
+        else:
+            dirty = child.dirty
+        if dirty != 1:
+            return
+        drawn = self._group.spritedict
+        old = drawn.get(child)
+        if old and old is not self._group._init_rect:
+            self._group.repaint_rect(old)
+            drawn[child] = self._group._init_rect
+        self._hidden.add(child)
+        child.dirty = 0
+
+    @staticmethod
+    def _covered(rect, cover):
+        """Return whether rect lies wholly within the rects of cover put
+together."""
+        for i, c in enumerate(cover):
+            if not c.colliderect(rect):
+                continue
+            if c.contains(rect):
+                return True
+            #Check the parts of rect outside c against the rest.
+            rest = cover[i + 1:]
+            top, bottom = max((rect.top, c.top)), min((rect.bottom, c.bottom))
+            parts = []
+            if rect.top < c.top:
+                parts.append(pygame.Rect(rect.left, rect.top, rect.width, c.top - rect.top))
+            if rect.bottom > c.bottom:
+                parts.append(pygame.Rect(rect.left, c.bottom, rect.width, rect.bottom - c.bottom))
+            if rect.left < c.left:
+                parts.append(pygame.Rect(rect.left, top, c.left - rect.left, bottom - top))
+            if rect.right > c.right:
+                parts.append(pygame.Rect(c.right, top, rect.right - c.right, bottom - top))
+            for part in parts:
+                if not LayeredDirtySprite._covered(part, rest):
+                    return False
+            return True
+        return False
 
     def update(self, *args, **kwargs):
         """update always invokes the LayeredDirty update function."""
@@ -67,47 +391,134 @@ LayeredDirty remove for sprites passed in."""
     @property
     def width(self):
         """Return the true width of the sprite bounds."""
-        return self.rect.width
+        return self.rectView.width
 
     @width.setter
     def width(self, value):
         """Sets the width of the group window."""
-        self._rect.width = value
+        self._size = (value, self._size[1])
+        #Replace the rect rather than change it; it may have been shared.
+        self._rect = pygame.Rect(self._rect.topleft, self._size)
         self._updateImage()
 
     @property
     def height(self):
         """Return the true height of the sprite bounds."""
-        return self.rect.height
+        return self.rectView.height
 
     @height.setter
     def height(self, value):
         """Sets the width of the group window."""
-        self._rect.height = value
+        self._size = (self._size[0], value)
+        self._rect = pygame.Rect(self._rect.topleft, self._size)
         self._updateImage()
 
+    @property
+    def scroll_x(self):
+        """Return the x content coordinate shown at the left edge."""
+        return self._scrollX
+
+    @scroll_x.setter
+    def scroll_x(self, value):
+        """Scroll the window horizontally to show content from x onwards."""
+        self._scroll(int(value), self._scrollY)
+
+    @property
+    def scroll_y(self):
+        """Return the y content coordinate shown at the top edge."""
+        return self._scrollY
+
+    @scroll_y.setter
+    def scroll_y(self, value):
+        """Scroll the window vertically to show content from y onwards."""
+        self._scroll(self._scrollX, int(value))
+
+    def _scroll(self, x, y):
+        """Move the view to x, y.  What is still visible is shifted in place,
+and only the strips scrolled into view are redrawn."""
+        dx, dy = x - self._scrollX, y - self._scrollY
+        if dx == 0 and dy == 0:
+            return
+        self._scrollX, self._scrollY = x, y
+        w, h = self._image.get_size()
+        if abs(dx) >= w or abs(dy) >= h:
+            self._repaint(pygame.Rect(0, 0, w, h))
+        else:
+            self._image.scroll(-dx, -dy)
+            if dx:
+                self._repaint(pygame.Rect(dx > 0 and w - dx or 0, 0, abs(dx), h))
+            if dy:
+                self._repaint(pygame.Rect(0, dy > 0 and h - dy or 0, w, abs(dy)))
+        self._shifted = True
+        if self._dirty == 0: self.dirty = 1
+
     @property
     def dirty(self):
         """This property is driven in part by its children sprites-
-if they are dirty, then this group/sprite is dirty too."""
-        if len([o for o in self._group.sprites() if 'dirty' not in dir(o) or o.dirty != 0]) > 0:
-            if self._dirty == 0: self._dirty = 1
+if they are dirty, then this group/sprite is dirty too.  Children report it
+when they change, and only changes that show in the view count.  The few that
+cannot report it are checked here."""
+        if self._pending & ManipulatableDirtySprite.STAGE_ALL:
+            self._update()
+        if self._dirty == 0 and self._refresh():
+            self.dirty = 1
         return self._dirty
     
     @dirty.setter
     def dirty(self, value):
         """This directly sets the value of the dirty property."""
-        self._dirty = value
+        ManipulatableDirtySprite.ManipulatableDirtySprite.dirty.fset(self, value)
+
+    @property
+    def regions(self):
+        """Return the areas changed by the last repaint of the cache, placed
+where they show up on the surface this window is drawn to.  If the window is
+rotated or scaled, that is its whole rect."""
+        rect = self.rectView
+        if (self._rotation or self._xscale != 1.0 or self._yscale != 1.0
+          or self._flattened):
+            return [rect]
+        return [r.move(rect.topleft) for r in self._regions]
+    #No setter for regions.
 
     @property
     def image(self):
         """If this sprite is dirty, then it's image is regenerated."""
-        if self.dirty != 0:
-            #Find our background image, if any.
-            group = self.groups()[0]
-            bgd = group._bgd
-            #Draw onto our internal image.
-            self._group.draw(self._image, bgd = bgd)
+        #Remake the cache in the new format if the display mode changed.
+        if self._format != DisplayFormat.generation():
+            self._updateImage()
+        if self._flat():
+            #The children go straight into the finished image, so any change
+            #among them means drawing it again.
+            if self._refresh() or self._dirtyChildren or self._shifted:
+                self._pending |= ManipulatableDirtySprite.STAGE_SCALE
+                self._shifted = False
+            return super(LayeredDirtySprite, self).image
+        if self._flattened:
+            #The cache was left behind while flattened.
+            self._flattened = False
+            self._repaint(self._image.get_rect())
+        if self._refresh() or self.dirty != 0:
+            #Find our background image, if any.  Without one, areas are
+            #cleared back to transparent.
+            groups = self.groups()
+            bgd = groups and groups[0]._bgd or None
+            if bgd is None:
+                bgd = self._blankImage
+            #Draw onto our internal image, only where children changed.
+            self._group._use_update = True
+            view = _ScrolledView(self._image, bgd, self._scrollX, self._scrollY)
+            regions = self._group.draw(view, bgd = bgd)
+            self._regions = [r.move(-view.x, -view.y) for r in regions]
+            #A scroll moved everything, not just the strips redrawn.
+            if self._shifted:
+                self._regions = [self._image.get_rect()]
+                self._shifted = False
+            #Forget children that were changed but came out clean.
+            self._dirtyChildren = set(o for o in self._dirtyChildren if o.dirty != 0)
+            #The content changed, so the transforms must be redone.
+            if self._regions:
+                self._pending |= ManipulatableDirtySprite.STAGE_SCALE
         #Now process through our parent object functionality.
         return super(LayeredDirtySprite, self).image
     
@@ -116,6 +527,210 @@ if they are dirty, then this group/sprite is dirty too."""
         """This function is being disabled- there is no way to change the image
 for this object directly."""
         pass
+
+    def pick(self, point, threshold = None):
+        """Return the topmost child under point, in the coordinates this
+window is placed in, or None.  The point is taken back through the window's
+transform and scroll, and only the children filed near it are looked at.
+Child windows are searched in turn, so the sprite returned is the deepest one
+hit; a window none of whose children are hit is passed over.  threshold is
+passed on to the children, to also test the alpha of the pixel hit."""
+        local = self._local(point)
+        if local is None:
+            return None
+        x, y = int(local[0]) + self._scrollX, int(local[1]) + self._scrollY
+        self._refresh()
+        layer = self._group.get_layer_of_sprite
+        order = self._order
+        children = sorted(self._index.query(pygame.Rect(x, y, 1, 1)),
+          key = lambda o: (layer(o), order[o]), reverse = True)
+        for child in children:
+            if not getattr(child, 'visible', 1):
+                continue
+            if hasattr(child, 'pick'):
+                hit = child.pick((x, y), threshold)
+            else:
+                hit = LayeredDirtySprite._pickPlain(child, x, y, threshold)
+            if hit is not None:
+                return hit
+        return None
+
+    @staticmethod
+    def _pickPlain(sprite, x, y, threshold):
+        """Hit test a sprite that has no pick of its own against its rect."""
+        rect = sprite.rect
+        if not rect.collidepoint(x, y):
+            return None
+        if threshold is not None:
+            image = sprite.image
+            if LayeredDirtySprite._alphaAt(image, (x - rect.x, y - rect.y)) <= threshold:
+                return None
+        return sprite
+
+    @property
+    def opaque(self):
+        """Return whether this window was declared fully opaque.  Its cache is
+redrawn in place, so this is never worked out."""
+        return bool(self._declared)
+
+    @opaque.setter
+    def opaque(self, value):
+        """Declare whether this window is fully opaque."""
+        self._declared = value
+
+    @property
+    def flatten(self):
+        """Return whether the children are drawn straight into the finished
+image when this window is rotated, scaled or faded."""
+        return self._flatten
+
+    @flatten.setter
+    def flatten(self, value):
+        """Set whether the children are drawn straight into the finished image
+when this window is rotated, scaled or faded.  Each child is then resampled
+once, with this window's transform added to its own, instead of the window
+resampling its cache of them.  Nested windows that also flatten are passed
+through the same way.  Children fading together may look different where
+they overlap, since each is faded on its own.  The cache is still used while
+the window is flipped or scaled unevenly, or any child in view reaches past
+its edges."""
+        self._flatten = bool(value)
+        self._invalidate(ManipulatableDirtySprite.STAGE_SCALE)
+
+    def _nestable(self):
+        """Return whether this window's children can be drawn straight onto
+another surface under an even, unflipped scale and a rotation."""
+        scale = self._xscale
+        if not self._flatten or scale != self._yscale or scale <= 0.0 or self._opacity <= 0.0:
+            return False
+        self._refresh()
+        view = self._view()
+        rect = self._index.rect
+        for child in self._index.query(view):
+            if not view.contains(rect(child)):
+                return False
+        return True
+
+    def _flat(self):
+        """Return whether the finished image is drawn from the children this
+time, rather than from the cache."""
+        if (not self._flatten or not self._rotation and self._xscale == 1.0
+          and self._yscale == 1.0 and self._opacity >= 1.0):
+            #Without a transform the cache is exact and redraws less.
+            return False
+        return self._nestable()
+
+    def _update(self, place = True):
+        """Draw the children straight into the finished image in place of the
+scale, rotate and opacity stages when flattening, then run the pipeline."""
+        if (self._pending & (ManipulatableDirtySprite.STAGE_IMAGE | ManipulatableDirtySprite.STAGE_TRANSFORM)
+          and not self._batching and self._flat()):
+            self._composite()
+        super(LayeredDirtySprite, self)._update(place)
+
+    def _composite(self):
+        """Draw the children in view onto a surface the size the rotated,
+scaled cache would have been."""
+        w, h = self._image.get_size()
+        scale = self._xscale
+        size = (int(w * scale), int(h * scale))
+        angle = self._rotation % 360
+        if angle % 90 == 0:
+            final = angle % 180 and (size[1], size[0]) or size
+        else:
+            #The size pygame.transform.rotate gives.
+            c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+            final = (int(math.fabs(c * size[0]) + math.fabs(s * size[1])),
+              int(math.fabs(s * size[0]) + math.fabs(c * size[1])))
+        final = (max((1, final[0])), max((1, final[1])))
+        surface = self._flatImage
+        if surface == None or surface.get_size() != final:
+            surface = self._flatImage = DisplayFormat.surface(final)
+        else:
+            surface.fill((0, 0, 0, 0))
+        #Find where the top left corner of the view lands.
+        cosine, sine = self._cosine, self._sine
+        hx, hy = -w * .5 * scale, -h * .5 * scale
+        self._flatDraw(surface, final[0] * .5 + hx * cosine - hy * sine,
+          final[1] * .5 + hx * sine + hy * cosine,
+          scale, cosine, sine, self._rotation, self._opacity)
+        self._opaqueImage = surface
+        self._mask = None
+        self._scaledSize = size
+        self._pending = ((self._pending & ~(ManipulatableDirtySprite.STAGE_IMAGE | ManipulatableDirtySprite.STAGE_TRANSFORM))
+          | ManipulatableDirtySprite.STAGE_POSITION | ManipulatableDirtySprite.PENDING_STALE)
+        self._flattened = True
+        if self._dirty == 0: self.dirty = 1
+
+    def _flatDraw(self, surface, ox, oy, scale, cosine, sine, rotation, opacity):
+        """Draw the children in view onto surface, where a point x, y of the
+view lands at ox + scale * (x * cosine - y * sine), oy + scale * (x * sine +
+y * cosine)."""
+        sx, sy = self._scrollX, self._scrollY
+        blit = surface.blit
+        MDS = ManipulatableDirtySprite.ManipulatableDirtySprite
+        for child in self._inView():
+            if not getattr(child, 'visible', 1):
+                continue
+            if isinstance(child, LayeredDirtySprite) and child._nestable():
+                #Pass the transform on to the children of the child window.
+                w, h = child._image.get_size()
+                cs = child._xscale
+                hw, hh = w * cs * .5, h * cs * .5
+                ccos, csin = child._cosine, child._sine
+                cx, cy = child._xcenter * hw, child._ycenter * hh
+                x = child._x - sx + cx * ccos - cy * csin - hw * ccos + hh * csin
+                y = child._y - sy + cy * ccos + cx * csin - hw * csin - hh * ccos
+                angle = rotation + child._rotation
+                child._flatDraw(surface, ox + scale * (x * cosine - y * sine),
+                  oy + scale * (x * sine + y * cosine), scale * cs,
+                  math.cos(math.radians(angle)), math.sin(math.radians(angle)),
+                  angle, opacity * child._opacity)
+                child._flattened = True
+                if child._dirty == 1: child.dirty = 0
+                continue
+            if isinstance(child, MDS) and not isinstance(child, LayeredDirtySprite):
+                if child._image == None:
+                    continue
+                x, y = child._x - sx, child._y - sy
+                shadow = self._shadow(child, child._image, ox + scale * (x * cosine - y * sine),
+                  oy + scale * (x * sine + y * cosine), rotation + child._rotation,
+                  child._xscale * scale, child._yscale * scale, child._opacity * opacity,
+                  child._xcenter, child._ycenter, child._quality)
+                if child._dirty == 1: child.dirty = 0
+            else:
+                #Anything else is resampled from its finished image.
+                rect = child.rect
+                x, y = rect.centerx - sx, rect.centery - sy
+                shadow = self._shadow(child, child.image, ox + scale * (x * cosine - y * sine),
+                  oy + scale * (x * sine + y * cosine), rotation, scale, scale, opacity,
+                  0.0, 0.0, None)
+                if child.dirty == 1: child.dirty = 0
+            blit(shadow.image, shadow.rectView)
+        #Whatever was queued for the cache waits for it to be used again.
+        del self._group.lostsprites[:]
+
+    def _shadow(self, child, image, x, y, rotation, xscale, yscale, opacity, xcenter, ycenter, quality):
+        """Return the sprite that renders child with the given transform,
+changing only what differs from last time."""
+        shadow = self._shadows.get(child)
+        if shadow is None:
+            shadow = ManipulatableDirtySprite.ManipulatableDirtySprite()
+            shadow.transformCache = getattr(child, 'transformCache', None)
+            shadow.atlasSteps = getattr(child, 'atlasSteps', None)
+            self._shadows[child] = shadow
+        if shadow._image is not image:
+            shadow.image = image
+        if shadow._x != x: shadow.x = x
+        if shadow._y != y: shadow.y = y
+        if shadow._rotation != rotation: shadow.rotation = rotation
+        if shadow._xscale != xscale: shadow.xscale = xscale
+        if shadow._yscale != yscale: shadow.yscale = yscale
+        if shadow._opacity != opacity: shadow.opacity = opacity
+        if shadow._xcenter != xcenter: shadow.xcenter = xcenter
+        if shadow._ycenter != ycenter: shadow.ycenter = ycenter
+        if shadow._quality != quality: shadow.quality = quality
+        return shadow
         
         
 def test():
@@ -1,171 +1,442 @@
 import pygame
 from pygame.locals import *
 import math
+import contextlib
+import RotationAtlas
+import DisplayFormat
+try:
+    import numpy
+    import pygame.surfarray
+except ImportError:
+    numpy = None
+
+#The _update pipeline is a graph of stages, each marked pending by one bit.
+#Property setters mark only the stages that really read that property, and
+#STAGE_FEEDS lists the stages that consume the output of each stage, so
+#running a stage marks just those as pending too.
+STAGE_IMAGE = 1
+STAGE_SCALE = 2
+STAGE_ROTATE = 4
+STAGE_OPACITY = 8
+STAGE_POSITION = 16
+STAGE_FEEDS = {
+    STAGE_IMAGE: STAGE_SCALE,
+    STAGE_SCALE: STAGE_ROTATE,
+    STAGE_ROTATE: STAGE_OPACITY | STAGE_POSITION,
+    STAGE_OPACITY: 0,
+    STAGE_POSITION: 0,
+}
+#The stages that produce the image, as opposed to placing it.
+STAGE_TRANSFORM = STAGE_SCALE | STAGE_ROTATE | STAGE_OPACITY
+#Every stage bit together.
+STAGE_ALL = STAGE_IMAGE | STAGE_TRANSFORM | STAGE_POSITION
+#SDL 2 applies a surface alpha on top of per-pixel alpha when blitting; SDL 1
+#ignores it for surfaces that have per-pixel alpha.
+SURFACE_ALPHA_BLENDS = pygame.version.vernum[0] >= 2
+#PENDING_STALE marks that the scaled and rotated images were skipped, either
+#by a cache hit or while the sprite could not be seen.
+PENDING_STALE = 32
 
 class ManipulatableDirtySprite(pygame.sprite.DirtySprite):
     """This class is to highly overload the DirtySprite class to have lots of
 neat little features, such as scaling and rotation."""
+    #The per-sprite state lives in fixed slots instead of a __dict__ entry
+    #each, which adds up with tens of thousands of sprites.
+    __slots__ = (
+        '_image',
+        #_scaledImage is the base image scaled and flipped.
+        '_scaledImage',
+        #_rotatedImage is the scaled image rotated.
+        '_rotatedImage',
+        #_opaqueImage is the rotated image faded to the opacity; this is the
+        #image that gets drawn.
+        '_opaqueImage',
+        #_opaqueScreen is a reusable fill of the opacity for fading.
+        '_opaqueScreen',
+        #_fadeBuffer is a private copy of _fadeSource that fades are made in,
+        #so that a fade alone does not need a new copy.
+        '_fadeBuffer',
+        '_fadeSource',
+        #_shown is the image last returned by the image property, _reads how
+        #many times in a row it was returned, and _converted the display
+        #format generation it was converted for.
+        '_shown',
+        '_reads',
+        '_converted',
+        '_scaledSize',
+        '_rect',
+        '_x',
+        '_y',
+        '_xscale',
+        '_yscale',
+        '_xcenter', #number of half-widths, 0.0 is center of sprite
+        '_ycenter', #number of half-heights, 0.0 is center of sprite
+        '_rotation',
+        '_sine',
+        '_cosine',
+        '_opacity',
+        #_pending holds the STAGE_ bits of the stages that need to run, plus
+        #the PENDING_STALE bit.
+        '_pending',
+        #_batching counts the open batch() blocks; while any are open, the
+        #pipeline is held back and the last rendered image and rect are kept.
+        '_batching',
+        '_atlas',
+        #_quality is this sprite's resampling quality, or None to follow
+        #defaultQuality.
+        '_quality',
+        #_dirty backs the dirty property, and _windows holds the
+        #LayeredDirtySprite windows that want to hear when it is set.
+        '_dirty',
+        '_windows',
+        #_declared is what opaque was set to, or None to work it out, and
+        #_solid whether the base image was found to be fully opaque, or None
+        #if it has not been looked at yet.
+        '_declared',
+        '_solid',
+        #_mask is the collision mask of the rotated image, or None until it
+        #is asked for again.
+        '_mask',
+    )
     _blank = None
-    _image = None
-    _opaqueScreen = None    
-    _opaqueImage = None
-    _scaledImage = None
-    _rotatedImage = None
-    _rect = None
-    _x = 0
-    _y = 0
-    _xscale = 1.0
-    _yscale = 1.0
-    _xcenter = 0.0 #number of half-widths, 0.0 is center of sprite
-    _ycenter = 0.0 #number of half-heights, 0.0 is center of sprite
-    _rotation = 0.0
-    _sine = 0.0
-    _cosine = 1.0
-    _opacity = 1.0
-    #_ichanged indicates if the image has been changed.
-    _ichanged = True
-    #_ochanged indicates if the image opacity has been changed.
-    _ochanged = False
-    #_schanged indicates if the scale has changed. 
-    _schanged = False
-    #_rchanged indicates if the image has been rotated.
-    _rchanged = False
-    #_pchanged indicates if the rect has changed. 
-    _pchanged = False
+    #shareRect makes the rect property return the rect itself instead of a
+    #copy, for groups that only read it.
+    shareRect = False
+    #transformCache, if set to a TransformCache, stores finished images so
+    #that revisited rotations and scales do not need to be resampled.
+    transformCache = None
+    #atlasSteps, if set, makes sprites that share a base image draw their
+    #frames from one RotationAtlas snapped to that many rotation steps.
+    atlasSteps = None
+    #scheduler, if set to a RenderScheduler, defers redoing the image
+    #stages to it.  Until it gets to the sprite, the last image and rect
+    #are kept.
+    scheduler = None
+    #defaultQuality is the resampling quality of sprites that have not set
+    #their own.  'fast' scales by nearest neighbour, 'smooth' uses
+    #smoothscale, and 'fused' scales and rotates in one rotozoom pass where
+    #the scale is even on both axes.
+    defaultQuality = 'smooth'
+    #opacityMode picks how the image is faded.  'surface' sets the surface
+    #alpha of a copy, 'array' multiplies the alpha channel with numpy, and
+    #'blend' multiplies with a BLEND_RGBA_MULT blit.  'auto' picks the
+    #cheapest one that works for the image and the SDL version.
+    opacityMode = 'auto'
+    #convertAfter is how many times in a row the same image must be drawn
+    #before it is converted to the display format, so that images that
+    #change every frame are not converted for nothing.  None never converts.
+    convertAfter = 2
+    #rleAccel makes converted images RLE accelerated, for sprites that are
+    #drawn often and changed rarely.
+    rleAccel = False
+    qualities = ('fast', 'smooth', 'fused')
+    #_atlases maps the id of each shared base image to its RotationAtlas.
+    _atlases = {}
 
     def __init__(self, image = None, *args, **kwargs):
-        if self._blank == None:
-            self._blank = pygame.Surface((1, 1), SRCALPHA)
-            ManipulatableDirtySprite._blank = self._blank
+        if ManipulatableDirtySprite._blank == None:
+            ManipulatableDirtySprite._blank = pygame.Surface((1, 1), SRCALPHA)
+        self._image = None
+        self._scaledImage = None
+        self._rotatedImage = None
+        self._opaqueImage = None
+        self._opaqueScreen = None
+        self._fadeBuffer = None
+        self._fadeSource = None
+        self._shown = None
+        self._reads = 0
+        self._converted = None
+        self._scaledSize = (0, 0)
+        self._rect = None
+        self._x = 0
+        self._y = 0
+        self._xscale = 1.0
+        self._yscale = 1.0
+        self._xcenter = 0.0
+        self._ycenter = 0.0
+        self._rotation = 0.0
+        self._sine = 0.0
+        self._cosine = 1.0
+        self._opacity = 1.0
+        self._pending = STAGE_IMAGE
+        self._batching = 0
+        self._atlas = None
+        self._quality = None
+        self._windows = ()
+        self._declared = None
+        self._solid = None
+        self._mask = None
         super(ManipulatableDirtySprite, self).__init__(*args, **kwargs)
         self.image = image
 
+    def _invalidate(self, stages):
+        """Mark stages of the pipeline to be redone.  The windows this sprite
+is in are told right away, as the change only makes the sprite dirty once the
+pipeline runs."""
+        self._pending |= stages
+        for window in self._windows:
+            window._childDirty(self, 1)
+
     #Property wrapper the rect that this object has.
     @property
     def rect(self):
-        """Return a copy of this object's rect."""
+        """Return a copy of this object's rect, or the rect itself if
+shareRect is set."""
         self._update()
+        if self.shareRect:
+            return self._rect
         return self._rect.copy()
     #No setter for rect.
 
+    @property
+    def dirty(self):
+        """Return the DirtySprite dirty flag.  Changes still waiting in the
+pipeline are made first, since they are what sets it."""
+        if self._pending & STAGE_ALL:
+            self._update()
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        """Set the dirty flag, and tell the windows this sprite is in."""
+        self._dirty = value
+        for window in self._windows:
+            window._childDirty(self, value)
+
+    @property
+    def bounds(self):
+        """Return a rect certain to hold this sprite once its pending changes
+are made, without making any that resample the image.  A move is cheap, so
+with only that pending this is the rect itself; otherwise it is the square
+the scaled image can reach at any rotation about its center of rotation."""
+        if not self._pending & (STAGE_IMAGE | STAGE_TRANSFORM) or self._image == None:
+            return self.rectView
+        w = self._image.get_width() * math.fabs(self._xscale) * .5
+        h = self._image.get_height() * math.fabs(self._yscale) * .5
+        reach = int(math.hypot(w, h) + math.hypot(self._xcenter * w, self._ycenter * h)) + 2
+        return pygame.Rect(int(self._x) - reach, int(self._y) - reach, reach * 2, reach * 2)
+    #No setter for bounds.
+
+    def _local(self, point):
+        """Map point, in the coordinates the sprite is placed in, back onto
+the base image.  Returns the (x, y) there as floats, or None if the point
+misses the transformed image.  The inverse rotation reuses the sine and
+cosine kept for placing the sprite."""
+        rect = self.rectView
+        image = self._image
+        if image == None or self._opacity <= 0.0 or self._xscale == 0.0 or self._yscale == 0.0:
+            return None
+        #Pixels are hit across their whole square, so measure from centers.
+        dx = point[0] + .5 - (rect.x + rect.width * .5)
+        dy = point[1] + .5 - (rect.y + rect.height * .5)
+        cosine, sine = self._cosine, self._sine
+        w, h = self._scaledSize
+        u = dx * cosine + dy * sine + w * .5
+        v = dy * cosine - dx * sine + h * .5
+        if not (0.0 <= u < w and 0.0 <= v < h):
+            return None
+        x, y = u / math.fabs(self._xscale), v / math.fabs(self._yscale)
+        if self._xscale < 0.0:
+            x = image.get_width() - x
+        if self._yscale < 0.0:
+            y = image.get_height() - y
+        return x, y
+
+    def pick(self, point, threshold = None):
+        """Return this sprite if point, in the coordinates it is placed in,
+lands on it, or None.  The test follows the rotated and scaled image rather
+than the rect.  If threshold is given, the pixel under point in the finished
+image must also have an alpha above it."""
+        if self._local(point) is None:
+            return None
+        if threshold is not None:
+            rect = self._rect
+            x, y = int(point[0]) - rect.x, int(point[1]) - rect.y
+            image = self._opaqueImage
+            if not (0 <= x < image.get_width() and 0 <= y < image.get_height()):
+                return None
+            if ManipulatableDirtySprite._alphaAt(image, (x, y)) <= threshold:
+                return None
+        return self
+
+    @staticmethod
+    def _alphaAt(image, position):
+        """Return the alpha image is drawn with at position.  A fade may be
+held in the surface alpha rather than in the pixels, so both count."""
+        alpha = image.get_at(position)[3]
+        surfaceAlpha = image.get_alpha()
+        if surfaceAlpha is not None:
+            alpha = alpha * surfaceAlpha // 255
+        return alpha
+
+    @property
+    def mask(self):
+        """Return the collision mask of the finished image, as used by
+pygame.sprite.collide_mask.  It is made from the image before fading, so a
+faded sprite still collides, and is kept until the image, scale or rotation
+changes."""
+        self._update()
+        if self._mask is None:
+            image, threshold = self._rotatedImage, 127
+            if (self._pending & PENDING_STALE or image is None
+              or self._opaqueImage is ManipulatableDirtySprite._blank):
+                #Only the finished image is at hand, so allow for its fading.
+                #from_surface does not see a fade held in the surface alpha,
+                #so only one made in the pixels is allowed for.
+                image = self._opaqueImage
+                if image.get_alpha() in (None, 255):
+                    threshold = int(threshold * min((1.0, self._opacity)))
+            self._mask = pygame.mask.from_surface(image, threshold)
+        return self._mask
+    #No setter for mask.
+
+    @property
+    def rectView(self):
+        """Return this object's rect without copying it.  The pipeline never
+changes a rect it has handed out, it makes a new one, so the result stays a
+valid snapshot.  It must be treated as read-only."""
+        self._update()
+        return self._rect
+    #No setter for rectView.
+
     @property
     def top(self):
         """Return the true top of the sprite bounds."""
+        self._update()
         return self._rect.top
     #No setter for top.
 
     @property
     def left(self):
         """Return the true left of the sprite bounds."""
+        self._update()
         return self._rect.left
     #No setter for left.
 
     @property
     def bottom(self):
         """Return the true bottom of the sprite bounds."""
-        return self.rect.bottom
+        self._update()
+        return self._rect.bottom
     #No setter for bottom.
 
     @property
     def right(self):
         """Return the true right of the sprite bounds."""
-        return self.rect.right
+        self._update()
+        return self._rect.right
     #No setter for right.
 
     @property
     def topleft(self):
         """Return the true topleft of the sprite bounds."""
-        return self.rect.topleft
+        self._update()
+        return self._rect.topleft
     #No setter for topleft.
 
     @property
     def bottomleft(self):
         """Return the true bottomleft of the sprite bounds."""
-        return self.rect.bottomleft
+        self._update()
+        return self._rect.bottomleft
     #No setter for bottomleft.
 
     @property
     def topright(self):
         """Return the true topright of the sprite bounds."""
-        return self.rect.topright
+        self._update()
+        return self._rect.topright
     #No setter for topright.
 
     @property
     def bottomright(self):
         """Return the true bottomright of the sprite bounds."""
-        return self.rect.bottomright
+        self._update()
+        return self._rect.bottomright
     #No setter for bottomright.
 
     @property
     def midtop(self):
         """Return the true middle top of the sprite bounds."""
-        return self.rect.midtop
+        self._update()
+        return self._rect.midtop
     #No setter for midtop.
 
     @property
     def midleft(self):
         """Return the true middle left of the sprite bounds."""
-        return self.rect.midleft
+        self._update()
+        return self._rect.midleft
     #No setter for midleft.
 
     @property
     def midbottom(self):
         """Return the true middle bottom of the sprite bounds."""
-        return self.rect.midbottom
+        self._update()
+        return self._rect.midbottom
     #No setter for midbottom.
 
     @property
     def midright(self):
         """Return the true middle right of the sprite bounds."""
-        return self.rect.midright
+        self._update()
+        return self._rect.midright
     #No setter for midright.
 
     @property
     def center(self):
         """Return the true center of the sprite bounds."""
-        return self.rect.center
+        self._update()
+        return self._rect.center
     #No setter for center.
 
     @property
     def centerx(self):
         """Return the true center of x of the sprite bounds."""
-        return self.rect.centerx
+        self._update()
+        return self._rect.centerx
     #No setter for centerx.
 
     @property
     def centery(self):
         """Return the true center of y of the sprite bounds."""
-        return self.rect.centery
+        self._update()
+        return self._rect.centery
     #No setter for centery.
 
     @property
     def size(self):
         """Return the true size of the sprite bounds."""
-        return self.rect.size
+        self._update()
+        return self._rect.size
     #No setter for size.
 
     @property
     def width(self):
         """Return the true width of the sprite bounds."""
-        return self.rect.width
+        self._update()
+        return self._rect.width
     #No setter for width.
 
     @property
     def height(self):
         """Return the true height of the sprite bounds."""
-        return self.rect.height
+        self._update()
+        return self._rect.height
     #No setter for height.
 
     @property
     def w(self):
         """Return the true width of the sprite bounds."""
-        return self.rect.w
+        self._update()
+        return self._rect.w
     #No setter for w.
 
     @property
     def h(self):
         """Return the true height of the sprite bounds."""
-        return self.rect.h
+        self._update()
+        return self._rect.h
     #No setter for h.
 
 
@@ -179,7 +450,7 @@ neat little features, such as scaling and rotation."""
     def x(self, value):
         """Set the x position of the specified center of the sprite."""
         self._x = value
-        self._pchanged = True
+        self._invalidate(STAGE_POSITION)
 
     @property
     def y(self):
@@ -190,7 +461,7 @@ neat little features, such as scaling and rotation."""
     def y(self, value):
         """Set the y position of the specified center of the sprite."""
         self._y = value
-        self._pchanged = True
+        self._invalidate(STAGE_POSITION)
 
     @property
     def xscale(self):
@@ -201,7 +472,7 @@ neat little features, such as scaling and rotation."""
     def xscale(self, value):
         """Set the x scaling value of the sprite."""
         self._xscale = value
-        self._schanged = True
+        self._invalidate(STAGE_SCALE)
 
     @property
     def yscale(self):
@@ -212,7 +483,7 @@ neat little features, such as scaling and rotation."""
     def yscale(self, value):
         """Set the y scaling value of the sprite."""
         self._yscale = value
-        self._schanged = True
+        self._invalidate(STAGE_SCALE)
 
     @property
     def xcenter(self):
@@ -223,7 +494,7 @@ neat little features, such as scaling and rotation."""
     def xcenter(self, value):
         """Set the x offset of the center of the sprite."""
         self._xcenter = value
-        self._rchanged = True
+        self._invalidate(STAGE_POSITION)
 
     @property
     def ycenter(self):
@@ -234,7 +505,7 @@ neat little features, such as scaling and rotation."""
     def ycenter(self, value):
         """Set the y offset of the center of the sprite."""
         self._ycenter = value
-        self._rchanged = True
+        self._invalidate(STAGE_POSITION)
 
     @property
     def rotation(self):
@@ -249,7 +520,59 @@ neat little features, such as scaling and rotation."""
         self._sine = math.sin(rads)
         #Negative because y increases going down the screen.
         self._cosine = math.cos(rads) 
-        self._rchanged = True
+        self._invalidate(STAGE_ROTATE)
+
+    @property
+    def quality(self):
+        """Return the resampling quality of the sprite."""
+        return self._quality or self.defaultQuality
+
+    @quality.setter
+    def quality(self, value):
+        """Set the resampling quality of the sprite, one of qualities.  None
+goes back to following defaultQuality."""
+        if value is not None and value not in self.qualities:
+            raise ValueError("quality must be one of %s, not %r" % (', '.join(self.qualities), value))
+        self._quality = value
+        self._invalidate(STAGE_SCALE)
+
+    @property
+    def opaque(self):
+        """Return whether the finished image covers its whole rect in fully
+opaque pixels, so that nothing under it shows through.  Unless it has been
+declared, this is worked out from the opacity, the rotation and the base
+image, which is only looked at once."""
+        if self._declared is not None:
+            return self._declared
+        image = self._image
+        if image == None or self._opacity < 1.0 or self._rotation % 90:
+            return False
+        xscale, yscale = math.fabs(self._xscale), math.fabs(self._yscale)
+        if xscale == 0.0 or yscale == 0.0:
+            return False
+        #rotozoom leaves soft edges even at right angles.
+        if self.quality == 'fused' and xscale == yscale != 1.0 and self._rotation % 360:
+            return False
+        if self._solid is None:
+            self._solid = ManipulatableDirtySprite._isSolid(image)
+        return self._solid
+
+    @opaque.setter
+    def opaque(self, value):
+        """Declare whether the finished image is fully opaque, or set None to
+have it worked out.  Declare it for images that are redrawn in place."""
+        self._declared = value
+
+    @staticmethod
+    def _isSolid(image):
+        """Return whether every pixel of image is fully opaque."""
+        alpha = image.get_alpha()
+        if alpha is not None and alpha < 255:
+            return False
+        if image.get_colorkey() is None and not image.get_flags() & SRCALPHA:
+            return True
+        w, h = image.get_size()
+        return pygame.mask.from_surface(image, 254).count() == w * h
 
     @property
     def opacity(self):
@@ -260,118 +583,355 @@ neat little features, such as scaling and rotation."""
     def opacity(self, value):
         """Set the opacity of the sprite."""
         self._opacity = value
-        self._ochanged = True
+        self._invalidate(STAGE_OPACITY)
 
     @property
     def image(self):
         """Return the cached image for this sprite.
 If it needs to be updated first, it is."""
         self._update()
-        return self._rotatedImage
+        image = self._opaqueImage
+        if image is not self._shown:
+            self._shown = image
+            self._reads = 0
+        if self.convertAfter is not None:
+            if self._reads < self.convertAfter:
+                self._reads += 1
+                if self._reads == self.convertAfter:
+                    self._convert()
+            elif self._converted != DisplayFormat.generation():
+                self._convert()
+        return self._opaqueImage
+
+    def _convert(self):
+        """Convert the finished image to the display format."""
+        image = self._opaqueImage
+        if image is not ManipulatableDirtySprite._blank:
+            image = DisplayFormat.convert(image, self.rleAccel)
+        self._opaqueImage = self._shown = image
+        self._converted = DisplayFormat.generation()
+
+    def _share(self, image):
+        """Return image as it is to be kept in a cache shared with other
+sprites.  It is converted to the display format once, on the way in, so that
+every sprite showing it shows the same converted surface.  convertAfter set
+to None leaves it as it is."""
+        if self.convertAfter is None:
+            return image
+        return DisplayFormat.convert(image, self.rleAccel)
 
     @image.setter
     def image(self, value):
         """Set the base image for this sprite."""
         self._image = value
-        self._ichanged = True
+        self._solid = None
+        self._invalidate(STAGE_IMAGE)
+        self._joinAtlas()
+
+    def _joinAtlas(self):
+        """Move this sprite into the shared atlas for its base image."""
+        if self._atlas is not None:
+            self._atlas.users.discard(self)
+            self._atlas = None
+        if self.atlasSteps is None or self._image is None:
+            return
+        atlas = ManipulatableDirtySprite._getAtlas(self._image, self.atlasSteps)
+        atlas.users.add(self)
+        self._atlas = atlas
+
+    def _cache(self):
+        """Return the cache finished images are kept in: the shared atlas if
+there is one, or else transformCache, which may be None."""
+        if self._atlas is not None and self._atlas.shared:
+            return self._atlas
+        return self.transformCache
+
+    @staticmethod
+    def _getAtlas(image, steps):
+        """Return the registered atlas for image, creating it if needed."""
+        atlases = ManipulatableDirtySprite._atlases
+        atlas = atlases.get(id(image))
+        if atlas is None or atlas.image is not image:
+            #Drop atlases whose sprites have all gone away.
+            for key in [k for k, a in atlases.items() if not a.pinned and len(a.users) == 0]:
+                del atlases[key]
+            atlas = RotationAtlas.RotationAtlas(image, steps)
+            atlases[id(image)] = atlas
+        return atlas
+
+    @staticmethod
+    def prerender(image, steps = 360, xscale = 1.0, yscale = 1.0, opacity = 1.0):
+        """Eagerly render every rotation step of image into its shared atlas.
+The atlas is pinned, so sprites using image are served from it even when only
+one of them exists.  Call this at load time with the scale and opacity the
+sprites will be shown at."""
+        atlas = ManipulatableDirtySprite._getAtlas(image, steps)
+        atlas.pinned = True
+        sprite = ManipulatableDirtySprite()
+        sprite.atlasSteps = atlas.steps
+        sprite.image = image
+        sprite.xscale = xscale
+        sprite.yscale = yscale
+        sprite.opacity = opacity
+        for angle in atlas.angles():
+            sprite.rotation = angle
+            sprite._update()
+        return atlas
     
-    def _update(self):
-        """This update function updates the image and it's rect as needed."""
+    def _fade(self, image, opacity, reuse):
+        """Return a copy of image faded to opacity, by the cheapest means
+opacityMode allows.  If reuse is set, the copy made for the last fade of the
+same image is faded again instead of copying anew."""
+        alpha = int(opacity * 255.0)
+        mode = self.opacityMode
+        #Without per-pixel alpha, only a surface alpha can fade the image.
+        if not image.get_flags() & SRCALPHA:
+            mode = 'surface'
+        elif mode == 'auto':
+            mode = SURFACE_ALPHA_BLENDS and 'surface' or 'array'
+        if mode == 'array' and numpy is None:
+            mode = 'blend'
+        if mode == 'blend':
+            screen = self._opaqueScreen
+            #The screen only grows, so a spinning sprite can reuse it.
+            if (screen == None or screen.get_width() < image.get_width()
+              or screen.get_height() < image.get_height()):
+                screen = pygame.Surface((max((image.get_width(), screen and screen.get_width() or 0)),
+                  max((image.get_height(), screen and screen.get_height() or 0))), SRCALPHA)
+                screen.fill((255, 255, 255, alpha))
+                self._opaqueScreen = screen
+            elif screen.get_at((0, 0))[3] != alpha:
+                screen.fill((255, 255, 255, alpha))
+            image = image.copy()
+            image.blit(screen, (0, 0), image.get_rect(), special_flags = BLEND_RGBA_MULT)
+            return image
+        buffer = self._fadeBuffer
+        if not reuse or buffer is None or self._fadeSource is not image:
+            buffer = image.copy()
+            if reuse:
+                self._fadeBuffer = buffer
+                self._fadeSource = image
+            else:
+                self._fadeBuffer = self._fadeSource = None
+        if mode == 'surface':
+            buffer.set_alpha(alpha)
+        else:
+            #Write the faded alpha of the source straight into the buffer.
+            source = pygame.surfarray.pixels_alpha(image)
+            target = pygame.surfarray.pixels_alpha(buffer)
+            numpy.multiply(source, opacity, out = target, casting = 'unsafe')
+            del source, target
+        return buffer
+
+    #The names transform() accepts.
+    _transformable = ('x', 'y', 'xscale', 'yscale', 'xcenter', 'ycenter', 'rotation', 'opacity', 'image')
+
+    def transform(self, **kwargs):
+        """Set several of x, y, xscale, yscale, xcenter, ycenter, rotation,
+opacity and image at once.  The pipeline runs at most once for all of them,
+the next time the image or rect is read."""
+        for name in kwargs:
+            if name not in self._transformable:
+                raise TypeError("transform() got an unexpected keyword argument '%s'" % name)
+        with self.batch():
+            for name, value in kwargs.items():
+                setattr(self, name, value)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that holds back the pipeline while properties are
+set one by one.  Reads of the rect and image inside the block return the
+last rendered values; the changes are applied together afterwards.  A sprite
+that was never rendered has no such values, so a read renders it as it
+stands."""
+        self._batching += 1
+        try:
+            yield self
+        finally:
+            self._batching -= 1
+
+    @staticmethod
+    def update_all(sprites):
+        """Bring every ManipulatableDirtySprite in sprites up to date in one
+pass.  Call this on a group before drawing it so that no pipeline runs in
+the middle of LayeredDirty.draw."""
+        for sprite in sprites:
+            if isinstance(sprite, ManipulatableDirtySprite) and sprite._pending & STAGE_ALL:
+                sprite._update()
+
+    def _update(self, place = True):
+        """This update function runs the pending stages of the pipeline to
+bring the image and its rect up to date.  If place is False the position
+stage is left pending, for a RectBatch to do in bulk."""
+        pending = self._pending
+        #A batch holds the pipeline back, unless there is nothing rendered
+        #to show yet.
+        if not pending & STAGE_ALL or (self._batching and self._rect is not None):
+            return
+        #Leave the image stages to the scheduler, if there is an image to
+        #show until then.
+        scheduler = self.scheduler
+        if (scheduler is not None and pending & (STAGE_IMAGE | STAGE_TRANSFORM)
+          and self._opaqueImage is not None and scheduler.defer(self)):
+            #The image shown until then still follows the sprite around.
+            if pending & STAGE_POSITION and place:
+                self._place()
+                self._pending = pending & ~STAGE_POSITION
+            return
         #Update image if needed.
-        if self._ichanged == True:
-            self._ichanged = False
-            #Destroy the opaque screen.
-            self._opaqueScreen = None
-            #Case: No image.
-            if self._image == None:
-                self._rotatedImage = ManipulatbleDirtySprite._blank
-                self._rect = pygame.Rect(self._x, self._y, 0, 0)
-                self._ochanged = False
-                self._schanged = False
-                self._rchanged = False
-                self._pchanged = False
-                return
-            #Otherwise, the opacity has changed!
-            self._ochanged = True
-        #Update opacity, if needed.
-        if self._ochanged == True:
-            self._ochanged = False
-            #By default, the scaling has also changed.
-            self._schanged = True
-            image = self._image
-            #Case: Image is transparent.
-            if self._opacity <= 0.0:
-                self._rotatedImage = ManipulatableDirtySprite._blank
-                self._rect = pygame.Rect(self._x, self._y, self._image.get_width(), self._image.get_height())
-                self._schanged = False
-                self._rchanged = False
-                self._pchanged = False
-                return
-            #Case: Image is not 100% opaque.
-            if self._opacity < 1.0:
-                if self._opaqueScreen == None:
-                    self._opaqueScreen = pygame.Surface(self._image.get_size(), SRCALPHA)
-                image = image.copy()
-                self._opaqueScreen.fill((255, 255, 255, int(max((0, self._opacity * 255.0)))))
-                image.blit(self._opaqueScreen, (0, 0), special_flags = BLEND_RGBA_MULT)
-            self._opaqueImage = image
+        if pending & STAGE_IMAGE:
+            pending = (pending & ~STAGE_IMAGE) | STAGE_FEEDS[STAGE_IMAGE]
+        #Case: No image.  None of the other stages has anything to work on
+        #until one is set.
+        if self._image == None:
+            self._opaqueImage = ManipulatableDirtySprite._blank
+            self._mask = None
+            self._rect = pygame.Rect(self._x, self._y, 0, 0)
+            self._pending = 0
+            if self._dirty == 0: self.dirty = 1
+            return
+        rotation, xscale, yscale, opacity = self._rotation, self._xscale, self._yscale, self._opacity
+        #Case: Image is transparent.  The transforms are skipped and redone
+        #once the sprite can be seen again.
+        if opacity <= 0.0:
+            self._opaqueImage = ManipulatableDirtySprite._blank
+            self._mask = None
+            self._rect = pygame.Rect(self._x, self._y, self._image.get_width(), self._image.get_height())
+            self._pending = PENDING_STALE
+            if self._dirty == 0: self.dirty = 1
+            return
+        #Case: Scaled to 0.
+        if xscale == 0.0 or yscale == 0.0:
+            self._opaqueImage = ManipulatableDirtySprite._blank
+            self._mask = None
+            self._rect = pygame.Rect(self._x, self._y, 0, 0)
+            self._pending = PENDING_STALE
+            if self._dirty == 0: self.dirty = 1
+            return
+        quality = self._quality or self.defaultQuality
+        #In fused mode an even scale is done by rotozoom in the rotate stage.
+        zoom = 1.0
+        if quality == 'fused' and math.fabs(xscale) == math.fabs(yscale):
+            zoom = math.fabs(xscale)
+        key = None
+        #Serve the finished image from the transform cache, if one is set.
+        cache = self._cache()
+        if cache is not None and pending & STAGE_TRANSFORM:
+            rotation, xscale, yscale, opacity = cache.quantize(rotation, xscale, yscale, opacity)
+            key = cache.key(self._image, rotation, xscale, yscale, opacity, quality)
+            entry = cache.get(key)
+            if entry is not None:
+                self._opaqueImage, self._scaledSize = entry
+                self._mask = None
+                pending = (pending & ~STAGE_TRANSFORM) | STAGE_POSITION | PENDING_STALE
+                key = None
+        #The intermediate images were skipped, so rebuild them.
+        if pending & PENDING_STALE and pending & STAGE_TRANSFORM:
+            pending = (pending & ~PENDING_STALE) | STAGE_SCALE
         #Update scaling if needed.
-        if self._schanged == True:
-            self._schanged = False
-            #By default, the rotation has changed, too.
-            self._rchanged = True
-            image = self._opaqueImage            
-            #Case: Scaled to 0.
-            if self._xscale == 0.0 or self._yscale == 0.0:
-                self._scaledImage = None
-                self._rotatedImage = ManipulatableDirtySprite._blank
-                self._rect = pygame.Rect(self._x, self._y, 0, 0)
-                self._schanged = False
-                self._rchanged = False
-                self._pchanged = False
-                return
+        if pending & STAGE_SCALE:
+            pending = (pending & ~STAGE_SCALE) | STAGE_FEEDS[STAGE_SCALE]
+            image = self._image
+            size = (int(math.fabs(image.get_width() * xscale)), int(math.fabs(image.get_height() * yscale)))
             #Case: Image needs scaling.
-            if math.fabs(self._xscale) != 1.0 or math.fabs(self._yscale) != 1.0:
-                image = pygame.transform.smoothscale(image, (math.fabs(image.get_width() * self._xscale), math.fabs(image.get_height() * self._yscale)))
-            if self._xscale < 0.0 or self._yscale < 0.0:
-                image = pygame.transform.flip(image, self._xscale < 0.0, self._yscale < 0.0)
+            if zoom == 1.0 and (math.fabs(xscale) != 1.0 or math.fabs(yscale) != 1.0):
+                if quality == 'fast':
+                    image = pygame.transform.scale(image, size)
+                else:
+                    image = pygame.transform.smoothscale(image, size)
+            if xscale < 0.0 or yscale < 0.0:
+                image = pygame.transform.flip(image, xscale < 0.0, yscale < 0.0)
             self._scaledImage = image
+            self._scaledSize = size
+            #The base image may have been redrawn in place, so do not trust
+            #a fade buffer copied from it.
+            self._fadeSource = None
         #Update rotation, if needed.
-        if self._rchanged == True:
-            self._rchanged = False
-            #By default, the position has also changed.
-            self._pchanged = True
+        if pending & STAGE_ROTATE:
+            pending = (pending & ~STAGE_ROTATE) | STAGE_FEEDS[STAGE_ROTATE]
             image = self._scaledImage
             #image.set_at((int((1 - self._xcenter) * image.get_width() * 0.5), int((1 - self._ycenter) * image.get_height() * 0.5)), (0, 255, 0, 255))
+            #Case: Image needs scaling and rotation in one pass.
+            if zoom != 1.0:
+                image = pygame.transform.rotozoom(image, -rotation, zoom)
             #Case: Image needs rotation
-            if self._rotation:
-                image = pygame.transform.rotate(image, -self._rotation)
+            elif rotation:
+                image = pygame.transform.rotate(image, -rotation)
             self._rotatedImage = image
+            self._mask = None
+        #Update opacity, if needed.  Fading the finished image is the same as
+        #fading the base image, but does not require resampling again.
+        if pending & STAGE_OPACITY:
+            pending = (pending & ~STAGE_OPACITY) | STAGE_FEEDS[STAGE_OPACITY]
+            image = self._rotatedImage
+            #Case: Image is not 100% opaque.
+            if opacity < 1.0:
+                #A surface handed to the cache must not be faded again later.
+                image = self._fade(image, opacity, key is None)
+            if key is not None:
+                image = self._share(image)
+                cache.put(key, self._image, image, self._scaledSize)
+            self._opaqueImage = image
+            if self._dirty == 0: self.dirty = 1
         #Update position, if needed.
-        if self._pchanged == True:
-            self._pchanged = False
-            rect = self._rotatedImage.get_rect()
-            ##We now have the width and height of our sprite.
-            ##Now calculate the top and left of the rect that
-            ##will describe where the sprite is to be rendered.
-            #Get half width and half height.
-            w, h = self._scaledImage.get_width() * .5, self._scaledImage.get_height() * .5
-            #Find the rotated center of rotation
-            ox = self._xcenter * w
-            oy = self._ycenter * h
-            rox = ox * self._cosine - oy * self._sine
-            roy = oy * self._cosine + ox * self._sine
-            #We now know the offset of rotation relative to the center of the
-            #rotated image in pixels.
-            #Move the rect to the base x and y location.
-            rect.move_ip(self._x, self._y)
-            #Get the half width and half height of the rotated image.
-            rw, rh = rect.width * .5, rect.height * .5
-            #Now move the rect out by the rotated center of rotation
-            #and the half size of the image.
-            self._rect = rect.move(int(rox - rw), int(roy - rh))
-            if self.dirty == 0: self.dirty = 1
-            
+        if pending & STAGE_POSITION:
+            if not place:
+                self._pending = pending & (STAGE_POSITION | PENDING_STALE)
+                return
+            self._place()
+        self._pending = pending & PENDING_STALE
+
+    def _place(self):
+        """Work out the rect of the finished image from the position and the
+center of rotation."""
+        rect = self._opaqueImage.get_rect()
+        ##We now have the width and height of our sprite.
+        ##Now calculate the top and left of the rect that
+        ##will describe where the sprite is to be rendered.
+        #Get half width and half height.
+        w, h = self._scaledSize[0] * .5, self._scaledSize[1] * .5
+        #Find the rotated center of rotation
+        ox = self._xcenter * w
+        oy = self._ycenter * h
+        rox = ox * self._cosine - oy * self._sine
+        roy = oy * self._cosine + ox * self._sine
+        #We now know the offset of rotation relative to the center of the
+        #rotated image in pixels.
+        #Move the rect to the base x and y location.
+        rect.move_ip(self._x, self._y)
+        #Get the half width and half height of the rotated image.
+        rw, rh = rect.width * .5, rect.height * .5
+        #Now move the rect out by the rotated center of rotation
+        #and the half size of the image.  This is a new rect, never the
+        #one that was handed out by rectView.
+        rect.move_ip(int(rox - rw), int(roy - rh))
+        self._rect = rect
+        if self._dirty == 0: self.dirty = 1
+        
+def memoryTest(count = 50000):
+    """Report the memory each sprite takes up, not counting its surfaces."""
+    import sys
+    pygame.init()
+    image = pygame.Surface((8, 8), SRCALPHA)
+    sprite = ManipulatableDirtySprite(image = image)
+    sprite.rect
+    print("object: %d bytes, __dict__: %d bytes with %d entries" % (
+      sys.getsizeof(sprite), sys.getsizeof(sprite.__dict__), len(sprite.__dict__)))
+    try:
+        import tracemalloc
+    except ImportError:
+        return
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sprites = [ManipulatableDirtySprite(image = image) for i in range(count)]
+    for i, sprite in enumerate(sprites):
+        sprite.x = i
+        sprite.rotation = i % 7
+        sprite.rect
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%.1f bytes per sprite over %d sprites" % (float(after - before) / count, count))
+
 def test():
     import test
     pygame.init()
@@ -0,0 +1,217 @@
+"""A pool of worker threads that renders sprite frames and lines of text
+before they are needed.  Frames are queued for the transforms a sprite looks
+set to reach next, and lines for text a TextBox is about to show.  Finished
+surfaces are handed to the shared caches on the main thread by collect, so
+the sprites and TextBoxes simply find them there when they next render."""
+
+import sys
+import threading
+import weakref
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import pygame
+from pygame.locals import *
+import ManipulatableDirtySprite
+import DisplayFormat
+import FontIndex
+import GlyphCache
+
+#_local holds the index and the glyphs of each worker thread.
+_local = threading.local()
+
+
+class PrerenderPool(object):
+    """This class runs render jobs on worker threads.  Sprites are only
+helped if they keep their frames in a cache, a transformCache or a shared
+atlas, since that is where the frames are handed over.  Call update once a
+frame on the main thread: it queues the next frames of the watched sprites
+and collects finished surfaces.  Workers never touch a surface or font the
+main thread uses: they render frames from a copy of each base image, taken
+the first time one of its frames is queued, so as with the transform cache a
+base image must not be drawn on once its frames are cached."""
+
+    def __init__(self, workers = 2, ahead = 4):
+        #ahead is how many frames past the current one are queued for each
+        #watched sprite.
+        self.ahead = ahead
+        self._jobs = queue.Queue()
+        self._done = queue.Queue()
+        #_queued holds the cache keys of the jobs not yet collected, and
+        #_watched maps each watched sprite to its transform last frame.
+        self._queued = set()
+        self._watched = {}
+        #_sources maps each base image to the copy the workers render it
+        #from, and _fonts each font key to a font for each worker.
+        self._sources = weakref.WeakKeyDictionary()
+        self._fonts = {}
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target = self._work, args = (i,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        """Return how many jobs are queued or running."""
+        return len(self._queued)
+
+    def _work(self, index):
+        """Run jobs until told to stop by a job of None."""
+        _local.index = index
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            key, store, render, args = job
+            try:
+                result = render(*args)
+            except Exception:
+                result = sys.exc_info()[1]
+            self._done.put((key, store, result))
+
+    def _submit(self, key, store, render, args):
+        """Queue a job, unless one for key is already queued."""
+        if key in self._queued:
+            return False
+        self._queued.add(key)
+        self._jobs.put((key, store, render, args))
+        return True
+
+    def collect(self):
+        """Hand every finished surface to its cache, and return how many
+there were.  An error raised by a job is raised again here."""
+        count = 0
+        while True:
+            try:
+                key, store, result = self._done.get_nowait()
+            except queue.Empty:
+                return count
+            self._queued.discard(key)
+            if isinstance(result, Exception):
+                raise result
+            store(key, result)
+            count += 1
+
+    @staticmethod
+    def _renderFrame(image, rotation, xscale, yscale, opacity, quality):
+        """Return the finished image of a sprite showing image with the
+transform given, and its scaled size.  A sprite of its own runs the
+pipeline, with no caches or scheduler to touch."""
+        sprite = ManipulatableDirtySprite.ManipulatableDirtySprite()
+        sprite.transformCache = None
+        sprite.atlasSteps = None
+        sprite.scheduler = None
+        sprite.quality = quality
+        sprite.transform(image = image, rotation = rotation, xscale = xscale,
+          yscale = yscale, opacity = opacity)
+        sprite._update()
+        result = sprite._opaqueImage
+        if result is image:
+            #An untransformed frame is the copy itself, which stays ours.
+            result = image.copy()
+        return result, sprite._scaledSize
+
+    def frame(self, sprite, rotation, xscale, yscale, opacity):
+        """Queue the frame of sprite at the transform given, and return
+whether it was queued.  Nothing is queued if the sprite has no cache, the
+frame is already in it, or it could not be seen."""
+        cache = sprite._cache()
+        image = sprite._image
+        if cache is None or image is None:
+            return False
+        quality = sprite.quality
+        rotation, xscale, yscale, opacity = cache.quantize(rotation, xscale, yscale, opacity)
+        if opacity <= 0.0 or xscale == 0.0 or yscale == 0.0:
+            return False
+        key = cache.key(image, rotation, xscale, yscale, opacity, quality)
+        if key in cache:
+            return False
+        def store(key, result):
+            cache.put(key, image, sprite._share(result[0]), result[1])
+        #A worker locks the surface it reads, and a locked surface cannot be
+        #blitted, so the workers never read the base image itself.
+        source = self._sources.get(image)
+        if source is None:
+            source = self._sources[image] = image.copy()
+        return self._submit(key, store, PrerenderPool._renderFrame,
+          (source, rotation, xscale, yscale, opacity, quality))
+
+    def watch(self, sprite):
+        """Start queueing the frames sprite looks set to need next, going by
+how its transform changed over the last frame."""
+        self._watched[sprite] = None
+
+    def unwatch(self, sprite):
+        """Stop queueing frames for sprite."""
+        self._watched.pop(sprite, None)
+
+    def update(self):
+        """Collect finished surfaces, then queue the next frames of every
+watched sprite.  Call once a frame."""
+        self.collect()
+        for sprite, last in list(self._watched.items()):
+            now = (sprite._rotation, sprite._xscale, sprite._yscale, sprite._opacity)
+            self._watched[sprite] = now
+            if last is None or last == now:
+                continue
+            steps = [b - a for a, b in zip(last, now)]
+            #Take the short way round the circle.
+            steps[0] = (steps[0] + 180.0) % 360.0 - 180.0
+            for i in range(1, self.ahead + 1):
+                self.frame(sprite, *[value + i * step for value, step in zip(now, steps)])
+
+    @staticmethod
+    def _renderLine(fonts, antialias, color, text):
+        """Return text drawn and laid out as a TextBox line is, with this
+thread's font out of fonts and glyphs that only this thread uses."""
+        font = fonts[_local.index]
+        glyphs = getattr(_local, 'glyphs', None)
+        if glyphs is None:
+            glyphs = _local.glyphs = GlyphCache.GlyphCache()
+        height = font.get_height()
+        image = pygame.Surface((max((1, glyphs.measure(font, text))), height), SRCALPHA)
+        image.fill((0, 0, 0, 0))
+        layout = []
+        for i in range(len(text)):
+            x = glyphs.place(font, text[:i + 1])
+            glyph = glyphs.glyph(font, antialias, color, text[i])
+            image.blit(glyph, (x, height - glyph.get_height()), None, BLEND_RGBA_MAX)
+            layout.append((x, glyph))
+        return image, layout
+
+    def text(self, box, text):
+        """Queue the lines box would show text in, so that setting its text
+to it later finds them rendered.  Return how many lines were queued."""
+        font = box._myFont
+        fontKey = FontIndex.fontKey(font)
+        if fontKey is None:
+            return 0
+        #The fonts are loaded here, as the font library must not load fonts
+        #on two threads at once.
+        fonts = self._fonts.get(fontKey)
+        if fonts is None:
+            fonts = self._fonts[fontKey] = [FontIndex.unshared(fontKey) for thread in self._threads]
+        cache = box.textCache
+        format = DisplayFormat.generation()
+        def store(key, result):
+            cache.put(key, DisplayFormat.convert(result[0]), result[1])
+        count = 0
+        for start, end in box._wrap(0, text):
+            line = text[start:end]
+            key = cache.key(font, box._antialias, box._color, line, format)
+            if key in cache:
+                continue
+            if self._submit(key, store, PrerenderPool._renderLine,
+              (fonts, box._antialias, tuple(box._color), line)):
+                count += 1
+        return count
+
+    def close(self):
+        """Stop the worker threads once the jobs queued have run."""
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
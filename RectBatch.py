@@ -0,0 +1,161 @@
+"""Vectorized placement for large groups of ManipulatableDirtySprites.  The
+positions, pivots, rotation terms and image sizes of every sprite are kept in
+numpy arrays, so working out the rects of the whole group is a handful of
+array operations instead of one _update call per sprite."""
+
+import pygame
+import numpy
+import ManipulatableDirtySprite
+
+
+class RectBatch(object):
+    """This class keeps the placement state of a group of sprites in arrays.
+Sprites may still be moved with their own setters; those are picked up on
+the next update.  Whole groups can also be moved at once by changing the x
+and y arrays in place, for instance batch.y += 2.  Each call to update brings
+every sprite's image up to date and then writes back only the rects that
+actually changed.  A sprite moved both ways in the same frame ends up where
+its setter put it.  It pays off for groups where most sprites move every
+frame, and most of all for ones moved through the arrays."""
+
+    def __init__(self, sprites = ()):
+        self.group = sprites
+        self._sprites = []
+        self._allocate(0)
+        self._adopt(list(sprites))
+
+    def _allocate(self, count):
+        """Make new, empty arrays for count sprites."""
+        self.x = numpy.zeros(count)
+        self.y = numpy.zeros(count)
+        self.xcenter = numpy.zeros(count)
+        self.ycenter = numpy.zeros(count)
+        self.sine = numpy.zeros(count)
+        self.cosine = numpy.ones(count)
+        #Scaled sizes, which the pivot is measured in.
+        self.scaledSize = numpy.zeros((count, 2))
+        #Sizes of the finished images, which the rects take.
+        self.size = numpy.zeros((count, 2), dtype = int)
+        #The last rects written back, and the x and y the sprites know of.
+        self._rects = numpy.zeros((count, 4), dtype = int)
+        self._known = numpy.zeros((count, 2))
+        #Rows reloaded from their sprites, whose rects must be written back.
+        self._loaded = numpy.ones(count, dtype = bool)
+        #Rows of sprites that are hidden by opacity or scale, or have no
+        #image.  Their rects do not use the pivot, so _update places them.
+        self._hidden = numpy.zeros(count, dtype = bool)
+
+    def _adopt(self, sprites):
+        """Make the arrays fit sprites.  The rows of sprites already held are
+kept, along with any moves made through them.  New sprites start at their
+own x and y, and the rest of their rows is filled in by the next update."""
+        names = ('x', 'y', 'xcenter', 'ycenter', 'sine', 'cosine', 'scaledSize',
+          'size', '_rects', '_known', '_loaded', '_hidden')
+        previous = [getattr(self, name) for name in names]
+        rows = dict((sprite, i) for i, sprite in enumerate(self._sprites))
+        self._sprites = sprites
+        self._allocate(len(sprites))
+        kept = []
+        source = []
+        new = []
+        for i, sprite in enumerate(sprites):
+            if sprite in rows:
+                kept.append(i)
+                source.append(rows[sprite])
+            else:
+                new.append(i)
+        if kept:
+            for name, array in zip(names, previous):
+                getattr(self, name)[kept] = array[source]
+        if new:
+            position = numpy.array([(sprites[i]._x, sprites[i]._y) for i in new], dtype = numpy.float64)
+            self.x[new] = self._known[new, 0] = position[:, 0]
+            self.y[new] = self._known[new, 1] = position[:, 1]
+            for i in new:
+                sprites[i]._pending |= ManipulatableDirtySprite.STAGE_POSITION
+
+    def _reload(self, rows, x, y):
+        """Take the x and y of the sprites in rows.  A move made through the
+arrays is kept unless the sprite was moved through its setter as well."""
+        self.x[rows] = numpy.where(x != self._known[rows, 0], x, self.x[rows])
+        self.y[rows] = numpy.where(y != self._known[rows, 1], y, self.y[rows])
+        self._known[rows, 0] = x
+        self._known[rows, 1] = y
+
+    def update(self):
+        """Bring every sprite in the group up to date, placing them all in
+one vectorized step."""
+        sprites = list(self.group)
+        if sprites != self._sprites:
+            self._adopt(sprites)
+        #Reload the rows of sprites that were changed through their setters.
+        pendingAll = ManipulatableDirtySprite.STAGE_ALL
+        place = ManipulatableDirtySprite.STAGE_POSITION
+        blank = ManipulatableDirtySprite.ManipulatableDirtySprite._blank
+        rows = []
+        states = []
+        hidden = []
+        for i, sprite in enumerate(sprites):
+            pending = sprite._pending
+            if pending & pendingAll and not sprite._batching:
+                if pending & pendingAll & ~place:
+                    sprite._update(False)
+                    pending = sprite._pending
+                if sprite._opaqueImage is blank:
+                    sprite._update()
+                    hidden.append(i)
+                elif pending & place:
+                    rows.append(i)
+                    states.append((sprite._x, sprite._y, sprite._xcenter, sprite._ycenter,
+                      sprite._sine, sprite._cosine) + sprite._scaledSize + sprite._opaqueImage.get_size())
+        if not sprites:
+            return
+        if hidden:
+            position = numpy.array([(sprites[i]._x, sprites[i]._y) for i in hidden], dtype = numpy.float64)
+            self._reload(hidden, position[:, 0], position[:, 1])
+            self._hidden[hidden] = True
+        self._hidden[rows] = False
+        if rows:
+            state = numpy.array(states, dtype = numpy.float64)
+            self._reload(rows, state[:, 0], state[:, 1])
+            self.xcenter[rows] = state[:, 2]
+            self.ycenter[rows] = state[:, 3]
+            self.sine[rows] = state[:, 4]
+            self.cosine[rows] = state[:, 5]
+            self.scaledSize[rows] = state[:, 6:8]
+            self.size[rows] = state[:, 8:10]
+            self._loaded[rows] = True
+        #Find the rotated center of rotation, as in _update.
+        ox = self.xcenter * self.scaledSize[:, 0] * .5
+        oy = self.ycenter * self.scaledSize[:, 1] * .5
+        rox = ox * self.cosine - oy * self.sine
+        roy = oy * self.cosine + ox * self.sine
+        #Rects take whole pixels, and int() rounds toward zero.
+        rects = numpy.empty_like(self._rects)
+        rects[:, 0] = numpy.trunc(self.x) + numpy.trunc(rox - self.size[:, 0] * .5)
+        rects[:, 1] = numpy.trunc(self.y) + numpy.trunc(roy - self.size[:, 1] * .5)
+        rects[:, 2:] = self.size
+        moved = (self.x != self._known[:, 0]) | (self.y != self._known[:, 1])
+        changed = (self._loaded | (rects != self._rects).any(axis = 1)) & ~self._hidden
+        #Only the sprites that moved or were reloaded are touched.
+        which = numpy.flatnonzero(moved)
+        for i, x, y in zip(which.tolist(), self.x[which].tolist(), self.y[which].tolist()):
+            sprite = sprites[i]
+            sprite._x = x
+            sprite._y = y
+            if self._hidden[i]:
+                sprite._pending |= place
+                sprite._update()
+                sprite.dirty = sprite._dirty or 1
+        Rect = pygame.Rect
+        which = numpy.flatnonzero(changed)
+        for i, rect in zip(which.tolist(), rects[which].tolist()):
+            sprite = sprites[i]
+            sprite._rect = Rect(rect)
+            #Set it even if it is already dirty, so listeners hear of the move.
+            sprite.dirty = sprite._dirty or 1
+            sprite._pending &= ~place
+        self._rects = rects
+        self._known[:, 0] = self.x
+        self._known[:, 1] = self.y
+        self._loaded[:] = False
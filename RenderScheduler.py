@@ -0,0 +1,77 @@
+"""A queue that spreads the re-rendering of TextBoxes and sprites over several
+frames.  Objects that have a scheduler set do not re-render the moment they are
+read after a change.  Instead they join the queue and keep showing their last
+rendered surface, and each frame renders as many of them as fit in a time
+budget."""
+
+import timeit
+
+
+class RenderScheduler(object):
+    """This class holds the objects waiting to be rendered again.  Call run
+once a frame, before drawing.  Objects that are shown are rendered first,
+then the ones that have waited longest.  An object is shown if its visible
+flag is set and, when a view rect is passed to run, its last rect overlaps
+it.  Anything with an _update method and a _rect can be queued."""
+
+    def __init__(self, budget = 0.004):
+        #budget is how many seconds run may spend rendering each frame.
+        self.budget = budget
+        #_queue maps each waiting object to the order it joined in.
+        self._queue = {}
+        self._added = 0
+        #_current is the object being rendered, which must not be deferred.
+        self._current = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __contains__(self, item):
+        return item in self._queue
+
+    def defer(self, item):
+        """Queue item to be rendered later, and return whether it was.  The
+object being rendered by run is never deferred."""
+        if item is self._current:
+            return False
+        if item not in self._queue:
+            self._added += 1
+            self._queue[item] = self._added
+        return True
+
+    def discard(self, item):
+        """Take item out of the queue, if it is there."""
+        self._queue.pop(item, None)
+
+    def _priority(self, item, view):
+        """Return the sort key of item: shown objects first, then the ones
+that have waited longest."""
+        shown = getattr(item, 'visible', 1) and (view is None or view.colliderect(item._rect))
+        return (not shown, self._queue[item])
+
+    def run(self, budget = None, view = None):
+        """Render queued objects until budget seconds, or the scheduler's own
+budget, have passed, and return how many are still waiting.  At least one
+object is rendered each call, so the queue always drains."""
+        if budget is None:
+            budget = self.budget
+        if not self._queue:
+            return 0
+        timer = timeit.default_timer
+        end = timer() + budget
+        items = sorted(self._queue, key = lambda o: self._priority(o, view))
+        for item in items:
+            del self._queue[item]
+            self._current = item
+            try:
+                item._update()
+            finally:
+                self._current = None
+            if timer() >= end:
+                break
+        return len(self._queue)
+
+    def flush(self):
+        """Render every queued object now."""
+        while self._queue:
+            self.run(float('inf'))
@@ -0,0 +1,30 @@
+"""A transform cache dedicated to one base image and shared by every sprite
+that displays it.  Rotations are snapped to a fixed number of steps around the
+circle so that a whole swarm of sprites draws from the same few frames."""
+
+import weakref
+import TransformCache
+
+
+class RotationAtlas(TransformCache.TransformCache):
+    """This class stores the transformed frames of a single base image.  The
+sprites using the image are tracked weakly in users; once more than one sprite
+uses the image, or the atlas has been pinned by a pre-render, the frames are
+served to all of them."""
+
+    def __init__(self, image, steps = 360, *args, **kwargs):
+        super(RotationAtlas, self).__init__(360.0 / steps, *args, **kwargs)
+        self.image = image
+        self.steps = steps
+        self.pinned = False
+        self.users = weakref.WeakSet()
+
+    @property
+    def shared(self):
+        """Return whether the frames of this atlas should be used."""
+        return self.pinned or len(self.users) > 1
+    #No setter for shared.
+
+    def angles(self):
+        """Return every snapped angle this atlas can hold, in degrees."""
+        return [i * self.angleStep for i in range(self.steps)]
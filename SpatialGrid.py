@@ -0,0 +1,96 @@
+"""A uniform grid over rects, for finding the items in an area without looking
+at every item.  Each item is filed under the cells its rect covers, so moving
+an item only touches the cells it leaves and enters."""
+
+import pygame
+
+
+class SpatialGrid(object):
+    """This class indexes items by rect in square cells of cellSize pixels.
+Items are anything hashable, usually sprites.  Rects are given in whatever
+coordinates the caller works in; they need not be positive."""
+
+    def __init__(self, cellSize = 64):
+        self.cellSize = cellSize
+        #_cells maps a cell to the set of items filed under it, and _items
+        #maps an item to its rect and the cells it is filed under.
+        self._cells = {}
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def _span(self, rect):
+        """Return the range of cells rect covers, as (left, top, right,
+bottom) inclusive."""
+        size = self.cellSize
+        return (rect[0] // size, rect[1] // size,
+          (rect[0] + max((0, rect[2] - 1))) // size,
+          (rect[1] + max((0, rect[3] - 1))) // size)
+
+    def rect(self, item):
+        """Return the rect item was last filed with, or None."""
+        entry = self._items.get(item)
+        return entry and entry[0]
+
+    def insert(self, item, rect):
+        """File item under rect, moving it if it is already in the grid."""
+        rect = pygame.Rect(rect)
+        span = self._span(rect)
+        entry = self._items.get(item)
+        if entry is not None:
+            if entry[1] == span:
+                self._items[item] = (rect, span)
+                return
+            self.remove(item)
+        cells = self._cells
+        left, top, right, bottom = span
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    cell = cells[(cx, cy)] = set()
+                cell.add(item)
+        self._items[item] = (rect, span)
+
+    def remove(self, item):
+        """Take item out of the grid, if it is there."""
+        entry = self._items.pop(item, None)
+        if entry is None:
+            return
+        cells = self._cells
+        left, top, right, bottom = entry[1]
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                cell = cells[(cx, cy)]
+                cell.discard(item)
+                if not cell:
+                    del cells[(cx, cy)]
+
+    def query(self, rect):
+        """Return the set of items whose rects overlap rect."""
+        rect = pygame.Rect(rect)
+        left, top, right, bottom = self._span(rect)
+        cells = self._cells
+        found = set()
+        if (right - left + 1) * (bottom - top + 1) > len(cells):
+            #The area covers more cells than are in use; walk those instead.
+            for (cx, cy), cell in cells.items():
+                if left <= cx <= right and top <= cy <= bottom:
+                    found.update(cell)
+        else:
+            for cx in range(left, right + 1):
+                for cy in range(top, bottom + 1):
+                    cell = cells.get((cx, cy))
+                    if cell:
+                        found.update(cell)
+        items = self._items
+        return set(item for item in found if rect.colliderect(items[item][0]))
+
+    def clear(self):
+        """Remove every item."""
+        self._cells.clear()
+        self._items.clear()
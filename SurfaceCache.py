@@ -0,0 +1,60 @@
+"""A least recently used store of surfaces with a budget in bytes.  It is the
+common part of the caches that keep rendered surfaces for reuse, such as
+TransformCache and TextCache, which add the keys for what they hold."""
+
+import collections
+
+
+class SurfaceCache(object):
+    """This class holds surfaces under keys built by its subclasses.  Once
+more than maxBytes worth of pixels are held, the least recently used
+surfaces are dropped.  The surfaces may be shared, so they must never be
+drawn on once stored."""
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the (image, value) pair stored for key, or None if there is
+no such entry.  A hit marks the entry as most recently used."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry[0], entry[1]
+
+    def put(self, key, image, value = None, keep = None):
+        """Store image under key.  value is any small piece of data the
+caller needs back along with the image, and keep any object that must stay
+alive as long as the entry does."""
+        if key in self._entries:
+            self._discard(key)
+        size = image.get_pitch() * image.get_height()
+        if size > self.maxBytes:
+            return
+        self._entries[key] = (image, value, size, keep)
+        self.bytes += size
+        while self.bytes > self.maxBytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        """Remove an entry and release its bytes from the budget."""
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+
+    def clear(self):
+        """Drop every cached surface."""
+        self._entries.clear()
+        self.bytes = 0
@@ -1,12 +1,104 @@
 import pygame
 from pygame.locals import *
+import bisect
+import DisplayFormat
+import GlyphCache
+import TextCache
+import FontIndex
+
+
+def _commonPrefix(a, b):
+    """Return the length of the longest common prefix of a and b.  Slices
+are compared rather than characters, which is much faster on long text."""
+    low, high = 0, min((len(a), len(b)))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _Line(object):
+    """One laid out line of a TextBox and the surface it shows.  Surfaces come
+from the shared text cache where they can.  A new one is made from the one
+before, so only the glyphs from the first character that changed are drawn."""
+
+    def __init__(self):
+        #start and end are where the line lies in the text of its TextBox,
+        #spaces it was broken at included.
+        self.start = 0
+        self.end = 0
+        self.image = None
+        #layout is a list of (x, glyph) for each character of drawnText, as
+        #drawn on image with the font, antialiasing and color in drawnKey.
+        self.layout = None
+        self.drawnText = ""
+        self.drawnKey = None
+
+    def forget(self):
+        """Let go of the surface, until the line is drawn again."""
+        self.image = None
+        self.layout = None
+
+    def render(self, text, height, font, antialias, color, glyphs, cache):
+        """Bring image up to date with text, and return whether it changed."""
+        key = (font, antialias, tuple(color))
+        if self.image is not None and key == self.drawnKey and text == self.drawnText:
+            return False
+        entry = cache.get(cache.key(font, antialias, color, text, DisplayFormat.generation()))
+        if entry is None:
+            entry = self._draw(text, height, font, antialias, color, glyphs, key)
+            cache.put(cache.key(font, antialias, color, text, DisplayFormat.generation()), *entry)
+        self.image, self.layout = entry
+        self.drawnText = text
+        self.drawnKey = key
+        return True
+
+    def _draw(self, text, height, font, antialias, color, glyphs, key):
+        """Return a new surface with text drawn on it, and its layout.  The
+part left of every glyph that changed is copied from the old surface, and the
+glyphs reaching past it are drawn."""
+        old = self.layout
+        same = 0
+        if old is not None and key == self.drawnKey:
+            same = _commonPrefix(self.drawnText, text)
+        #Lay out the characters that changed.
+        layout = old[:same] if same else []
+        for i in range(same, len(text)):
+            x = glyphs.place(font, text[:i + 1])
+            layout.append((x, glyphs.glyph(font, antialias, color, text[i])))
+        w = max((1, glyphs.measure(font, text)))
+        image = DisplayFormat.surface((w, height))
+        left = 0
+        if same:
+            left = min([x for x, glyph in old[same:] + layout[same:]] or [w])
+            image.blit(self.image, (0, 0), (0, 0, left, height))
+        if left < w:
+            image.set_clip((left, 0, w - left, height))
+            for x, glyph in layout:
+                if x + glyph.get_width() > left:
+                    image.blit(glyph, (x, height - glyph.get_height()), None, BLEND_RGBA_MAX)
+            image.set_clip(None)
+        return image, layout
 
-class TextBox (pygame.sprite.DirtySprite):
-    __fonts = {}
 
+class TextBox (pygame.sprite.DirtySprite):
     splitChars = (' ', '-')
+    #The glyphs text is put together from, and the lines put together from
+    #them, shared by every TextBox.
+    glyphCache = GlyphCache.GlyphCache()
+    textCache = TextCache.TextCache()
+    #scheduler, if set to a RenderScheduler, defers drawing changes to it.
+    #Until it gets to the box, the last image is kept.
+    scheduler = None
 
     _changed = False
+    #_dirty backs the dirty property, and _windows holds the
+    #LayeredDirtySprite windows that want to hear when it is set.
+    _dirty = 1
+    _windows = ()
 
     _text = ""
     _rect = None
@@ -19,48 +111,217 @@ class TextBox (pygame.sprite.DirtySprite):
     _color = None
     _myFont = None
     _image = None
+    #_format is the display format generation _image was made in.
+    _format = None
+    #_lines holds a _Line for each line _drawnText was wrapped into with the
+    #font and width in _wrapKey.  None means it must be wrapped from
+    #scratch.
+    _lines = None
+    _drawnText = ""
+    _wrapKey = None
+    #_spacing is the (height, linesize) of the font _image was last drawn
+    #with.
+    _spacing = None
 
     def __init__(self, text  = "", x = 0, y = 0, width = 50, height = 12, fontName = " ", fontSize = 10, italic = False, bold = False, underline = False, antialias = True, color = (255, 255, 255, 255), *args, **kwargs):
         super(TextBox, self). __init__(*args, **kwargs)
         self._rect = pygame.Rect(x, y, width, height)
         self._fontName = fontName
         self._fontSize = fontSize
-        self._myFont = self._getFont(fontName, fontSize)
         self._text = text
         self._italic = italic
         self._bold = bold
         self._underline = underline
+        self._loadFont()
         self._antialias = antialias
         self._color = color
         self._update()
 
-    def _getFont(self, fontName, size):
-        choices = filter(lambda (x):x.find(fontName) != -1 , pygame.font.get_fonts())
-        if len(choices) == 0:
-            fontFile = pygame.font.get_default_font()
-        else:
-            fontFile = pygame.font.match_font(choices[0])
-        key =(fontFile, size)
-        if key not in TextBox.__fonts:
-            TextBox.__fonts[key] = pygame.font.Font(fontFile, size)
-        return TextBox.__fonts[key]        
+    def _loadFont(self):
+        """Load the shared font for our name, size and style.  Names are
+looked up in the font index, so the system fonts are only scanned once."""
+        self._myFont = FontIndex.font(self._fontName, self._fontSize,
+          self._bold, self._italic, self._underline)
+
+    def _invalidate(self):
+        """Mark the text to be drawn again, and tell the windows this object
+is in right away."""
+        self._changed = True
+        for window in self._windows:
+            window._childDirty(self, 1)
 
     def _update(self):
-        """Update the surface taht contains our text."""
-        if self._image == None or self._image.get_size() != self._rect.size:
-            self._image = pygame.Surface(self._rect.size, SRCALPHA)
-        self._image.fill((0, 0, 0, 0))
-        self._renderText()
-        self.dirty = 1
+        """Update the surface that contains our text."""
+        scheduler = self.scheduler
+        if scheduler is not None and self._image is not None and scheduler.defer(self):
+            return
+        full = False
+        if (self._image == None or self._image.get_size() != self._rect.size
+          or self._format != DisplayFormat.generation()):
+            if self._format != DisplayFormat.generation() and self._lines:
+                for line in self._lines:
+                    line.forget()
+            self._format = DisplayFormat.generation()
+            self._image = DisplayFormat.surface(self._rect.size)
+            full = True
         self._changed = False
+        if self._renderText(full):
+            self.dirty = 1
+
+    def _renderText(self, full = False):
+        """Wrap the text into lines and draw the ones that changed, and
+return whether anything was drawn.  Lines are stacked up from the bottom of
+the box, so when there are more than fit, the last ones show."""
+        count = self._lines and len(self._lines)
+        key = self._wrapKey
+        self._wrapText()
+        lines = self._lines
+        image = self._image
+        w, h = image.get_size()
+        font = self._myFont
+        height, spacing = font.get_height(), font.get_linesize()
+        #The old lines may sit in other places, so repaint everything.
+        if len(lines) != count or self._wrapKey != key or self._spacing != (height, spacing):
+            full = True
+        self._spacing = (height, spacing)
+        #Find the lines that show.
+        first = max((0, len(lines) - 1 - (h - 1) // spacing))
+        for line in lines[:first]:
+            if line.image is not None:
+                line.forget()
+        areas = []
+        for i in range(first, len(lines)):
+            line = lines[i]
+            if line.render(self._text[line.start:line.end], height, font,
+              self._antialias, self._color, self.glyphCache, self.textCache):
+                #Surface.fill does not clip rects that start above the surface.
+                area = pygame.Rect(0, h - height - (len(lines) - 1 - i) * spacing, w, height)
+                areas.append(area.clip(image.get_rect()))
+        if full:
+            areas = [image.get_rect()]
+        if not areas:
+            return False
+        for area in areas:
+            image.fill((0, 0, 0, 0), area)
+            image.set_clip(area)
+            for i in range(first, len(lines)):
+                y = h - height - (len(lines) - 1 - i) * spacing
+                if y < area.bottom and y + height > area.top:
+                    image.blit(lines[i].image, (0, y), None, BLEND_RGBA_MAX)
+            image.set_clip(None)
+        return True
+
+    def _wrapText(self):
+        """Bring _lines up to date with the text.  Wrapping starts over from
+the line before the first change, and stops as soon as a line starts where an
+old one did past the end of the change, since from there on the lines are the
+same as before."""
+        text = self._text
+        key = (self._myFont, self._rect.width)
+        lines = self._lines
+        if lines is None or key != self._wrapKey:
+            lines = self._lines = []
+            self._wrapKey = key
+            old = None
+        else:
+            old = self._drawnText
+            if old == text:
+                return
+        if old is None:
+            k = 0
+            start = 0
+            end = len(text)
+            delta = 0
+            starts = []
+        else:
+            #Find the changed part of the text.
+            same = _commonPrefix(old, text)
+            suffix = min((_commonPrefix(old[::-1], text[::-1]), min((len(old), len(text))) - same))
+            end = len(text) - suffix
+            delta = len(text) - len(old)
+            starts = [line.start for line in lines]
+            #A shorter word may now fit on the line before.
+            k = max((0, bisect.bisect_right(starts, same) - 2))
+            start = lines[k].start
+        spans = []
+        tail = len(lines)
+        for span in self._wrap(start):
+            if span[0] >= end:
+                j = bisect.bisect_left(starts, span[0] - delta)
+                if j < len(starts) and starts[j] == span[0] - delta:
+                    tail = j
+                    break
+            spans.append(span)
+        #Lines keep their surfaces where they can, so a line that changed
+        #only at its end is only drawn over there.
+        reused = lines[k:min((tail, k + len(spans)))]
+        new = []
+        for i, (s, e) in enumerate(spans):
+            line = reused[i] if i < len(reused) else _Line()
+            line.start, line.end = s, e
+            new.append(line)
+        rest = lines[tail:] if tail < len(lines) else []
+        for line in rest:
+            line.start += delta
+            line.end += delta
+        self._lines = lines[:k] + new + rest
+        self._drawnText = text
+
+    def _wrap(self, start, text = None):
+        """Yield the (start, end) of each line of text from start on, text
+being our own if not given.  Lines are broken after a character in
+splitChars where they can be, and anywhere where a word does not fit on a
+line on its own.  Spaces at a break stay at the end of the line they follow,
+and a newline always breaks."""
+        if text is None:
+            text = self._text
+        width = self._rect.width
+        glyphs = self.glyphCache
+        font = self._myFont
+        while True:
+            stop = text.find('\n', start)
+            if stop == -1:
+                stop = len(text)
+            #Find how many characters fit, which is at least one.
+            low, high = 1, stop - start
+            if high > 0 and glyphs.measure(font, text[start:stop]) <= width:
+                low = high
+            while low < high:
+                middle = (low + high + 1) // 2
+                if glyphs.measure(font, text[start:start + middle]) <= width:
+                    low = middle
+                else:
+                    high = middle - 1
+            end = min((start + low, stop))
+            if end < stop and not text[end].isspace():
+                #Go back to the last split character.
+                split = max([text.rfind(c, start, end) for c in self.splitChars])
+                if split >= start:
+                    end = split + 1
+            while end < stop and text[end].isspace():
+                end += 1
+            yield start, end
+            if end == len(text):
+                return
+            start = end
+            if end == stop:
+                start += 1
+
+    @property
+    def dirty(self):
+        """Return the DirtySprite dirty flag.  A change still waiting to be
+drawn is drawn first, since it is what sets it."""
+        if self._changed:
+            self._update()
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        """Set the dirty flag, and tell the windows this object is in."""
+        self._dirty = value
+        for window in self._windows:
+            window._childDirty(self, value)
 
-    def _renderText(self):
-        self._myFont.set_italic(self._italic)
-        self._myFont.set_bold(self._bold)
-        self._myFont.set_underline(self._underline)
-        image = self._myFont.render(self._text, self._antialias, self._color)
-        self._image.blit(image, (0, self._image.get_height() - image.get_height()))
-            
     @property
     def rect(self):
         """Return the bounding box for this object.  Recalculate the object if
@@ -74,7 +335,7 @@ it has changed."""
     def image(self):
         """Return the rendered image for this object.  Recalculate the object
 if it has changed."""
-        if self._changed:
+        if self._changed or self._format != DisplayFormat.generation():
             self._update()
         return self._image
     #No setter property fot image.
@@ -88,7 +349,8 @@ if it has changed."""
     def x(self, value):
         """Set the left bound for this object.  Mark this object as dirty."""
         self._rect.left = value
-        if self.dirty == 0: self.dirty = 1
+        #Set it even if it is already dirty, so windows hear of the move.
+        self.dirty = self._dirty or 1
 
     @property
     def y(self):
@@ -99,7 +361,8 @@ if it has changed."""
     def y(self, value):
         """Set the left bound for this object.  Mark the object as dirty."""
         self._rect.top = value
-        if self.dirty == 0: self.dirty = 1
+        #Set it even if it is already dirty, so windows hear of the move.
+        self.dirty = self._dirty or 1
 
     @property
     def width(self):
@@ -110,7 +373,7 @@ if it has changed."""
     def width(self, value):
         """Set the left bound for this object.  Mark this object as dirty."""
         self._rect.width = value
-        self._changed = True
+        self._invalidate()
 
     @property
     def height(self):
@@ -121,7 +384,7 @@ if it has changed."""
     def height(self, value):
         """Set the left bound for this object.  Mark the object as dirty."""
         self._rect.height = value
-        self._changed = True
+        self._invalidate()
 
     @property
     def bold(self):
@@ -132,7 +395,8 @@ if it has changed."""
     def bold(self, value):
         """Set the bold for this object."""
         self._bold = value
-        self._changed = True
+        self._loadFont()
+        self._invalidate()
 
     @property
     def italic(self):
@@ -143,7 +407,8 @@ if it has changed."""
     def italic(self, value):
         """Set the italic for this object."""
         self._italic = value
-        self._changed = True
+        self._loadFont()
+        self._invalidate()
 
     @property
     def underline(self):
@@ -154,7 +419,8 @@ if it has changed."""
     def underline(self, value):
         """Set the underline for this object."""
         self._underline = value
-        self._changed = True
+        self._loadFont()
+        self._invalidate()
 
     @property
     def color(self):
@@ -165,7 +431,7 @@ if it has changed."""
     def color(self, value):
         """Set the color for this object."""
         self._color = value
-        self._changed = True
+        self._invalidate()
 
     @property
     def antialias(self):
@@ -176,7 +442,7 @@ if it has changed."""
     def antialias(self, value):
         """Set the antialias for this object."""
         self._antialias = value
-        self._changed = True
+        self._invalidate()
 
     @property
     def fontName(self):
@@ -187,7 +453,8 @@ if it has changed."""
     def fontName(self, value):
         """Set the fontName for this object."""
         self._fontName = value
-        self._changed = True
+        self._loadFont()
+        self._invalidate()
 
     @property
     def fontSize(self):
@@ -198,7 +465,8 @@ if it has changed."""
     def fontSize(self, value):
         """Set the fontSize for this object."""
         self._fontSize = value
-        self._changed = True
+        self._loadFont()
+        self._invalidate()
 
     @property
     def text(self):
@@ -209,7 +477,7 @@ if it has changed."""
     def text(self, value):
         """Set the text this object displays."""
         self._text = value
-        self._changed = True
+        self._invalidate()
 
 def test():
     import test
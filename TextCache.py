@@ -0,0 +1,18 @@
+"""A least recently used store of rendered lines of text, shared by every
+TextBox.  A string shown in several places, or shown again, is only rendered
+once."""
+
+import SurfaceCache
+
+
+class TextCache(SurfaceCache.SurfaceCache):
+    """This class holds rendered text surfaces keyed by font, antialiasing,
+color and text, with the font standing for its style as in GlyphCache."""
+
+    def __init__(self, maxBytes = 4 * 1024 * 1024):
+        super(TextCache, self).__init__(maxBytes)
+
+    def key(self, font, antialias, color, text, format = None):
+        """Build the lookup key for text.  format is the display format the
+surface is made in, so surfaces made for an old display are not reused."""
+        return (font, antialias, tuple(color), format, text)
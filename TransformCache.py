@@ -0,0 +1,45 @@
+"""A least recently used store of transformed sprite surfaces.  Sprites that
+return to a rotation, scale and opacity they have already been rendered at can
+fetch the finished surface from here instead of resampling their base image
+again."""
+
+import SurfaceCache
+
+
+class TransformCache(SurfaceCache.SurfaceCache):
+    """This class holds transformed surfaces keyed by the identity of the base
+image plus the quantized angle, scale, flip and opacity used to make them.
+Angles are snapped to angleStep degrees and scales to scaleStep so that a
+spinning or pulsing sprite revisits the same handful of keys."""
+
+    def __init__(self, angleStep = 1.0, scaleStep = 0.015625, opacityStep = 1.0 / 255.0, maxBytes = 16 * 1024 * 1024):
+        self.angleStep = angleStep
+        self.scaleStep = scaleStep
+        self.opacityStep = opacityStep
+        super(TransformCache, self).__init__(maxBytes)
+
+    def quantize(self, rotation, xscale, yscale, opacity):
+        """Snap the transform values to the steps of this cache.  Returns a
+tuple of (rotation, xscale, yscale, opacity) that should be used to render
+the surface stored under the matching key."""
+        if self.angleStep:
+            rotation = (round(rotation / self.angleStep) * self.angleStep) % 360.0
+        if self.scaleStep:
+            xscale = round(xscale / self.scaleStep) * self.scaleStep
+            yscale = round(yscale / self.scaleStep) * self.scaleStep
+        if self.opacityStep:
+            opacity = round(opacity / self.opacityStep) * self.opacityStep
+        return rotation, xscale, yscale, min((1.0, opacity))
+
+    def key(self, image, rotation, xscale, yscale, opacity, quality = None):
+        """Build the lookup key for already quantized transform values.
+Surfaces resampled at different qualities are kept apart."""
+        return (id(image), rotation, abs(xscale), abs(yscale),
+          xscale < 0.0, yscale < 0.0, opacity, quality)
+
+    def put(self, key, base, image, value = None):
+        """Store a transformed image under key.  The base image is kept alive
+with the entry so that its id cannot be reused by another surface while the
+entry exists.  value is any small piece of data the caller needs back along
+with the image."""
+        super(TransformCache, self).put(key, image, value, base)